@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from functools import cached_property
+import numpy as np
+from edge_matrix import *
+from graph import OSMArrays
+
+
+"""
+[module: artifacts]
+
+This module is used to package everything a query needs into one
+versioned directory: the inter_edges_matrix as uncompressed CSR .npy
+files, the sub_edges bundle, the edge_index arrays (with the reverse
+index) and optionally the top-K file and the way transition matrix. Everything is memory-mapped on
+first use, so processes on one host share pages and start instantly.
+The manifest keeps checksums of every file and a fingerprint of the
+road network, to catch artifacts built from a different OSM extract.
+
+output/artifacts/
+    manifest.json
+    matrix/{indptr,indices,data,entry_keys}.npy
+    sub_edges/...   (graph.save_sub_edges_bundle)
+    edge_index/...  (edge_matrix.save_edge_index_arrays)
+    top_k/...       (optional)
+    transitions/{indptr,indices,data,entry_keys}.npy  (optional, functions.build_transition_matrix)
+"""
+
+artifacts_dir = 'output/artifacts'
+ARTIFACTS_FORMAT_VERSION = 1
+NETWORK_ARRAYS = ('ways', 'way_offsets', 'way_nodes')
+
+def get_file_sha256(filename, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_network_fingerprint(ways, way_offsets, way_nodes):
+    # Hash of the highway ways (ids and node lists), independent of how they were stored
+    digest = hashlib.sha256()
+    for column in (ways, way_offsets, way_nodes):
+        digest.update(np.ascontiguousarray(column, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+def get_sub_edges_fingerprint(sub_edges_dir):
+    return get_network_fingerprint(*(np.load(os.path.join(sub_edges_dir, f"{name}.npy"), mmap_mode='r')
+                                     for name in NETWORK_ARRAYS))
+
+def save_matrix_arrays(inter_edges_matrix, dirname):
+    inter_edges_matrix = inter_edges_matrix.tocsr()
+    inter_edges_matrix.sort_indices()
+    os.makedirs(dirname, exist_ok=True)
+    np.save(os.path.join(dirname, 'indptr.npy'), inter_edges_matrix.indptr)
+    np.save(os.path.join(dirname, 'indices.npy'), inter_edges_matrix.indices)
+    np.save(os.path.join(dirname, 'data.npy'), inter_edges_matrix.data)
+
+    # (row, col) keys of the stored entries, so batched lookups need no pass over the matrix at load
+    indptr = inter_edges_matrix.indptr
+    rows = np.repeat(np.arange(inter_edges_matrix.shape[0], dtype=np.int64), np.diff(indptr))
+    np.save(os.path.join(dirname, 'entry_keys.npy'), rows * inter_edges_matrix.shape[1] + inter_edges_matrix.indices)
+
+def save_matrix_artifacts(inter_edges_matrix, edge_index, sub_edges_dir=sub_edges_dir, dirname=artifacts_dir,
+                          top_k=None, osm_file=None, build_config=None, transition_matrix=None):
+    """
+    Write the artifact directory next to `dirname` and swap it in with a
+    rename, so readers never see a half-written bundle.
+    """
+    if inter_edges_matrix.shape[0] != len(edge_index) + 1:
+        raise ValueError(f"Matrix shape {inter_edges_matrix.shape} does not match edge_index ({len(edge_index)} edges)")
+    sub_edge_lookup = SubEdgeLookup(sub_edges_dir)
+    sub_edge_lookup.check_edge_index(edge_index)
+    if transition_matrix is not None and transition_matrix.shape != inter_edges_matrix.shape:
+        raise ValueError(f"Transition matrix shape {transition_matrix.shape} does not match {inter_edges_matrix.shape}")
+
+    time1 = time.time()
+    tmp_dir = f"{dirname.rstrip(os.sep)}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    save_matrix_arrays(inter_edges_matrix, os.path.join(tmp_dir, 'matrix'))
+    shutil.copytree(sub_edges_dir, os.path.join(tmp_dir, 'sub_edges'))
+    save_edge_index_arrays(edge_index, os.path.join(tmp_dir, 'edge_index'))
+    if top_k is not None:
+        os.makedirs(os.path.join(tmp_dir, 'top_k'))
+        for name, column in top_k.items():
+            np.save(os.path.join(tmp_dir, 'top_k', f"{name}.npy"), column)
+    if transition_matrix is not None:
+        save_matrix_arrays(transition_matrix, os.path.join(tmp_dir, 'transitions'))
+
+    files = {}
+    for root, _, names in os.walk(tmp_dir):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, tmp_dir)] = {'bytes': os.path.getsize(path), 'sha256': get_file_sha256(path)}
+
+    manifest = {
+        'format': 'inter_edges_artifacts',
+        'version': ARTIFACTS_FORMAT_VERSION,
+        'created_at': time.time(),
+        'edge_size': len(edge_index),
+        'nnz': int(inter_edges_matrix.nnz),
+        'network_fingerprint': get_network_fingerprint(sub_edge_lookup.ways, sub_edge_lookup.way_offsets,
+                                                       sub_edge_lookup.way_nodes),
+        'osm_file': None if osm_file is None else {'name': os.path.basename(osm_file),
+                                                  'sha256': get_file_sha256(osm_file)},
+        'build_config': build_config or {},
+        'top_k': top_k is not None,
+        'transitions': transition_matrix is not None,
+        'files': files,
+    }
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    old_dir = f"{dirname.rstrip(os.sep)}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(dirname):
+        os.replace(dirname, old_dir)
+    os.replace(tmp_dir, dirname)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    time2 = time.time()
+    print(f"Save artifacts to {dirname} successfully ({time2-time1}s)")
+    return manifest
+
+class MatrixArtifacts:
+    """
+    Lazy view of an artifact directory. Only the manifest is read up front;
+    each part is memory-mapped the first time it is used.
+    """
+    def __init__(self, dirname=artifacts_dir, mmap_mode='r'):
+        self.dirname = dirname
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(dirname, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+        if (self.manifest.get('format') != 'inter_edges_artifacts'
+                or self.manifest.get('version') != ARTIFACTS_FORMAT_VERSION):
+            raise ValueError(f"Unsupported artifacts in {dirname}: format={self.manifest.get('format')}, "
+                             f"version={self.manifest.get('version')}")
+
+        # Cheap structural check; verify() compares full checksums
+        for name, entry in self.manifest['files'].items():
+            path = os.path.join(dirname, name)
+            if not os.path.exists(path) or os.path.getsize(path) != entry['bytes']:
+                raise ValueError(f"Artifact file {path} is missing or does not match the manifest")
+        self.edge_size = self.manifest['edge_size']
+
+    def load_array(self, *parts):
+        return np.load(os.path.join(self.dirname, *parts), mmap_mode=self.mmap_mode)
+
+    def load_csr(self, name):
+        size = self.edge_size + 1
+        return sparse.csr_matrix((self.load_array(name, 'data.npy'), self.load_array(name, 'indices.npy'),
+                                  self.load_array(name, 'indptr.npy')), shape=(size, size), copy=False)
+
+    @cached_property
+    def matrix(self):
+        return self.load_csr('matrix')
+
+    @cached_property
+    def entry_keys(self):
+        return self.load_array('matrix', 'entry_keys.npy')
+
+    @cached_property
+    def sub_edge_lookup(self):
+        return SubEdgeLookup(os.path.join(self.dirname, 'sub_edges'), self.mmap_mode)
+
+    @cached_property
+    def edge_index(self):
+        return load_edge_index_arrays(os.path.join(self.dirname, 'edge_index'), self.mmap_mode)
+
+    @cached_property
+    def top_k(self):
+        if not self.manifest['top_k']:
+            return None
+        names = [name[len('top_k/'):-len('.npy')] for name in self.manifest['files'] if name.startswith('top_k/')]
+        return {name: self.load_array('top_k', f"{name}.npy") for name in names}
+
+    @cached_property
+    def transition_matrix(self):
+        # Bundles written before transitions existed have no 'transitions' key
+        if not self.manifest.get('transitions'):
+            return None
+        return self.load_csr('transitions')
+
+    def verify(self):
+        # Full sha256 of every file against the manifest (reads everything once)
+        mismatched = [name for name, entry in self.manifest['files'].items()
+                      if get_file_sha256(os.path.join(self.dirname, name)) != entry['sha256']]
+        if mismatched:
+            raise ValueError(f"Artifacts in {self.dirname} are corrupted: {mismatched}")
+        # Sub-edge lookups give bundle position + 1, which must be the edge_index of the matrix
+        self.sub_edge_lookup.check_edge_index(self.edge_index)
+        return True
+
+    def check_network(self, network):
+        """
+        Raise if the artifacts were built from another road network.
+        `network` is a sub_edges bundle directory, an OSMArrays or an OSM file
+        (compared by file checksum when the manifest recorded one).
+        """
+        if isinstance(network, OSMArrays):
+            fingerprint = get_network_fingerprint(network.ways, network.way_offsets, network.way_nodes)
+        elif os.path.isdir(network):
+            fingerprint = get_sub_edges_fingerprint(network)
+        elif self.manifest.get('osm_file') is not None:
+            if get_file_sha256(network) != self.manifest['osm_file']['sha256']:
+                raise ValueError(f"Artifacts in {self.dirname} were built from another OSM extract "
+                                 f"({self.manifest['osm_file']['name']}), not {network}")
+            return True
+        else:
+            osm_arrays = load_osm_arrays(network)
+            fingerprint = get_network_fingerprint(osm_arrays.ways, osm_arrays.way_offsets, osm_arrays.way_nodes)
+
+        if fingerprint != self.manifest['network_fingerprint']:
+            raise ValueError(f"Artifacts in {self.dirname} were built from another road network than {network}")
+        return True
+
+def load_matrix_artifacts(dirname=artifacts_dir, mmap_mode='r'):
+    matrix_artifacts = MatrixArtifacts(dirname, mmap_mode)
+    print("Load artifacts successfully")
+    return matrix_artifacts
+
+# Package the current build once, then load it lazily everywhere
+# edge_index = open_edge_index(index_file)
+# save_matrix_artifacts(load_inter_edges_matrix(matrix_file), edge_index, sub_edges_dir, osm_file=osm_file,
+#                       top_k=load_top_k(top_k_file))
+# matrix_artifacts = load_matrix_artifacts()
+# matrix_artifacts.check_network(sub_edges_dir)
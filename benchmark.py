@@ -0,0 +1,189 @@
+import json
+import multiprocessing
+import pickle
+import resource
+import sys
+import time
+from edge_matrix import *
+from ingest import resolve_history_files, count_inter_edges_files
+
+
+"""
+[module: benchmark]
+
+This module is used to compare the original code paths with
+their replacements:
+- starmap vs chunked worker pool for the inter_edges_matrix
+  (serialization volume sent to / from workers and wall time)
+- OSMHandler + networkx vs the lean OSM ingest (peak RSS, wall time)
+- window size of the inter_edges_matrix build (wall time, triples
+  emitted, matrix density)
+- multi-file ingestion at 1..N workers (files/s, MB/s, speedup)
+"""
+
+def measure_starmap_volume(json_file, total_sub_edges):
+    # Original path pickles (trip, total_sub_edges) for every trip
+    sub_edges_bytes = len(pickle.dumps(total_sub_edges))
+    task_bytes = 0
+    result_bytes = 0
+    for trip in iter_trips(json_file):
+        task_bytes += sub_edges_bytes + len(pickle.dumps(trip))
+        result_bytes += len(pickle.dumps(process_intermediate_edges(trip, total_sub_edges)))
+    return task_bytes, result_bytes
+
+def measure_pool_volume(json_file, total_sub_edges, edge_index, processes, chunk_size=50, windows=10):
+    sub_edge_index = get_sub_edge_index(total_sub_edges, edge_index)
+    init_worker(sub_edge_index, len(edge_index), windows)
+
+    # Pool path pickles the lookup once per worker, then only raw lines and partial counts
+    task_bytes = processes * len(pickle.dumps((sub_edge_index, len(edge_index), windows)))
+    result_bytes = 0
+    for task in enumerate(iter_line_chunks(json_file, chunk_size)):
+        task_bytes += len(pickle.dumps(task))
+        result_bytes += len(pickle.dumps(process_trip_chunk(*task)))
+    return task_bytes, result_bytes
+
+def time_starmap_path(json_file, total_sub_edges, edge_index):
+    start = time.time()
+    inter_edges_freq = merge_edges_frequency(parse_raw_data(json_file, total_sub_edges))
+    create_inter_edges_matrix(inter_edges_freq, len(edge_index), edge_index)
+    return time.time() - start
+
+def time_pool_path(json_file, total_sub_edges, edge_index, processes, chunk_size=50):
+    start = time.time()
+    build_inter_edges_matrix_parallel(json_file, total_sub_edges, edge_index,
+                                      chunk_size=chunk_size, processes=processes)
+    return time.time() - start
+
+def benchmark_pool(json_file, total_sub_edges, edge_index, processes=None, chunk_size=50):
+    processes = processes or cpu_count()
+    starmap_tasks, starmap_results = measure_starmap_volume(json_file, total_sub_edges)
+    pool_tasks, pool_results = measure_pool_volume(json_file, total_sub_edges, edge_index, processes, chunk_size)
+
+    result = {
+        'processes': processes,
+        'chunk_size': chunk_size,
+        'starmap': {
+            'task_bytes': starmap_tasks,
+            'result_bytes': starmap_results,
+            'seconds': time_starmap_path(json_file, total_sub_edges, edge_index),
+        },
+        'pool': {
+            'task_bytes': pool_tasks,
+            'result_bytes': pool_results,
+            'seconds': time_pool_path(json_file, total_sub_edges, edge_index, processes, chunk_size),
+        },
+    }
+    return result
+
+def run_osm_handler(osm_file):
+    G, total_edges = create_graph_from_osm(osm_file)
+    return {'nodes': G.number_of_nodes(), 'ways': len(total_edges)}
+
+def run_lean_osm(osm_file):
+    _, osm_arrays = create_lean_graph_from_osm(osm_file)
+    return {'nodes': len(osm_arrays.nodes), 'ways': len(osm_arrays.ways)}
+
+def measure_in_subprocess(queue, func, *args):
+    start = time.time()
+    result = func(*args)
+    result['seconds'] = time.time() - start
+    # ru_maxrss is in KiB on Linux
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put(result)
+
+def run_measured(func, *args):
+    # Fresh process per run, so the peak RSS of one run does not leak into the other
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=measure_in_subprocess, args=(queue, func) + args)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def benchmark_osm_ingest(osm_file):
+    return {
+        'osm_handler': run_measured(run_osm_handler, osm_file),
+        'lean': run_measured(run_lean_osm, osm_file),
+    }
+
+def count_emitted_triples(encoded_trips, windows, max_triples=None):
+    return sum(count_window_triples(len(edges), get_trip_window(len(edges), windows, max_triples))
+               for edges in encoded_trips)
+
+def benchmark_windows(json_file, total_sub_edges, edge_index, windows_list=(10, 25, 50, None),
+                      max_triples=None, processes=None):
+    # windows=None is the unbounded window (every pair of edges of a trip)
+    size = len(edge_index) + 1
+    encoded_trips = load_encoded_trips(json_file, get_sub_edge_index(total_sub_edges, edge_index))
+    
+    results = []
+    for windows in windows_list:
+        start = time.time()
+        inter_edges_matrix = build_inter_edges_matrix_parallel(json_file, total_sub_edges, edge_index, windows,
+                                                               processes=processes, max_triples=max_triples)
+        results.append({
+            'windows': windows,
+            'max_triples': max_triples,
+            'seconds': time.time() - start,
+            'triples': count_emitted_triples(encoded_trips, windows, max_triples),
+            'nnz': int(inter_edges_matrix.nnz),
+            'density': inter_edges_matrix.nnz / size ** 2,
+        })
+    return results
+
+def get_worker_counts(max_processes=None):
+    # 1, 2, 4, ... up to max_processes, always ending on max_processes
+    max_processes = max_processes or cpu_count()
+    counts = [1]
+    while counts[-1] * 2 < max_processes:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_processes:
+        counts.append(max_processes)
+    return counts
+
+def benchmark_ingest(source, total_sub_edges, edge_index, processes_list=None, chunk_bytes=8 * 1024 * 1024):
+    # Throughput of count_inter_edges_files (counting only, no final merge) per worker count
+    files = resolve_history_files(source)
+    disk_mb = sum(os.path.getsize(filename) for filename in files) / 1024 / 1024
+
+    results = []
+    for processes in processes_list or get_worker_counts():
+        start = time.time()
+        partial_counts = count_inter_edges_files(files, total_sub_edges, edge_index, chunk_bytes=chunk_bytes,
+                                                 processes=processes)
+        seconds = time.time() - start
+        partial_counts.cleanup()
+        results.append({
+            'processes': processes,
+            'seconds': seconds,
+            'files_per_s': len(files) / seconds,
+            'mb_per_s': disk_mb / seconds,
+            'speedup': results[0]['seconds'] / seconds if results else 1.0,
+        })
+    return {'files': len(files), 'disk_mb': disk_mb, 'chunk_bytes': chunk_bytes, 'runs': results}
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'osm':
+        bench_osm_file = sys.argv[2] if len(sys.argv) > 2 else osm_file
+        print(json.dumps(benchmark_osm_ingest(bench_osm_file), indent=4))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'windows':
+        bench_json_file = sys.argv[2] if len(sys.argv) > 2 else json_file
+        total_sub_edges = load_total_sub_edges(total_sub_edges_file)
+        edge_index = load_edge_index(index_file)
+        
+        print(json.dumps(benchmark_windows(bench_json_file, total_sub_edges, edge_index), indent=4))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'ingest':
+        # python benchmark.py ingest 'jsonFiles/history/*.json*' [max_workers]
+        bench_source = sys.argv[2] if len(sys.argv) > 2 else json_file
+        max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+        print(json.dumps(benchmark_ingest(bench_source, sub_edges_dir, open_edge_index(index_file),
+                                          get_worker_counts(max_workers)), indent=4))
+    else:
+        bench_json_file = sys.argv[1] if len(sys.argv) > 1 else json_file
+        total_sub_edges = load_total_sub_edges(total_sub_edges_file)
+        edge_index = load_edge_index(index_file)
+
+        print(json.dumps(benchmark_pool(bench_json_file, total_sub_edges, edge_index), indent=4))
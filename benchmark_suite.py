@@ -0,0 +1,214 @@
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from edge_matrix import *
+from benchmark import run_measured
+
+
+"""
+[module: benchmark_suite]
+
+This module is used to benchmark the edge-matrix build and query paths
+on synthetic data, so results can be compared across commits offline.
+For every scale it generates a bus_history-shaped JSON-lines file with
+total_edges / total_sub_edges, then times each stage separately in a
+fresh process (seconds, traced peak memory per stage, peak RSS).
+
+python benchmark_suite.py [output.json] [scale ...]
+"""
+
+SCALES = {
+    'small': {'n_ways': 2000, 'n_vehicles': 100, 'trips_per_vehicle': 4},
+    'medium': {'n_ways': 20000, 'n_vehicles': 800, 'trips_per_vehicle': 4},
+    # Same number of vehicles / trips as the HoChiMinh history (3347 vehicles, ~13944 trips)
+    'large': {'n_ways': 100000, 'n_vehicles': 3347, 'trips_per_vehicle': 4},
+}
+
+def generate_synthetic_network(n_ways, seed=0):
+    # Ways are node chains; most start where an earlier way ends, so trips can walk through them
+    rnd = random.Random(seed)
+    total_edges = {}
+    ends = []
+    node = 1000000
+    for way in range(n_ways):
+        if ends and rnd.random() < 0.8:
+            nodes = [rnd.choice(ends)]
+        else:
+            node += 1
+            nodes = [node]
+        for _ in range(rnd.randint(1, 6)):
+            node += 1
+            nodes.append(node)
+        ends.append(nodes[-1])
+        total_edges[str(100000000 + way)] = nodes
+    return total_edges
+
+def get_synthetic_sub_edges(total_edges):
+    # Same key format as output/total_sub_edges ('("u", "v")' -> way id), both directions
+    total_sub_edges = {}
+    for way, nodes in total_edges.items():
+        for u, v in zip(nodes[:-1], nodes[1:]):
+            total_sub_edges[f'("{u}", "{v}")'] = int(way)
+            total_sub_edges[f'("{v}", "{u}")'] = int(way)
+    return total_sub_edges
+
+def generate_synthetic_trip(rnd, ways, starts, min_sub_edges=50, max_sub_edges=400):
+    # Random walk over connected ways, with a few unmapped sub-edges like the real data
+    target = rnd.randint(min_sub_edges, max_sub_edges)
+    nodes = ways[rnd.randrange(len(ways))]
+    path = []
+    while len(path) < target:
+        path.extend([str(u), str(v)] for u, v in zip(nodes[:-1], nodes[1:]))
+        if rnd.random() < 0.02:
+            path.append(["0", "1"])
+        following = starts.get(nodes[-1])
+        nodes = ways[rnd.choice(following)] if following else ways[rnd.randrange(len(ways))]
+    return path
+
+def generate_synthetic_data(out_dir, n_ways, n_vehicles, trips_per_vehicle=4, seed=0):
+    os.makedirs(out_dir, exist_ok=True)
+    rnd = random.Random(seed)
+    total_edges = generate_synthetic_network(n_ways, seed)
+    ways = list(total_edges.values())
+    starts = {}
+    for position, nodes in enumerate(ways):
+        starts.setdefault(nodes[0], []).append(position)
+
+    with open(os.path.join(out_dir, 'total_edges'), 'w') as f:
+        json.dump(total_edges, f)
+    with open(os.path.join(out_dir, 'total_sub_edges'), 'w') as f:
+        json.dump(get_synthetic_sub_edges(total_edges), f)
+    with open(os.path.join(out_dir, 'bus_history.json'), 'w') as f:
+        for vehicle in range(n_vehicles):
+            trip_list = [{'edgesOfPath2': generate_synthetic_trip(rnd, ways, starts),
+                          'timeStamp': [1700000000 + 3600 * rnd.randint(0, 23)]}
+                         for _ in range(trips_per_vehicle)]
+            f.write(json.dumps({'vehicleNumber': f"51B{vehicle:05d}", 'routeId': rnd.randint(1, 150),
+                                'varId': rnd.randint(1, 2), 'tripList': trip_list}) + '\n')
+    print(f"Save synthetic data to {out_dir} successfully")
+
+def measure_stage(stages, name, func, *args):
+    # Wall time and traced peak memory (Python + NumPy allocations) of one stage
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    stages[name] = {'seconds': seconds, 'peak_mb': (peak - before) / 1024 / 1024}
+    return result
+
+def load_vehicles(json_file):
+    with open(json_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def map_sub_edges(vehicles, total_sub_edges):
+    # Sub-edge -> way mapping alone, as done at the top of process_intermediate_edges
+    return [[total_sub_edges[tuple(sub_edge)] for sub_edge in trip['edgesOfPath2']
+             if tuple(sub_edge) in total_sub_edges]
+            for vehicle in vehicles for trip in vehicle['tripList']]
+
+def process_trips(vehicles, total_sub_edges):
+    # Serial, so the stage measures process_intermediate_edges itself rather than the pool
+    return [process_intermediate_edges(trip, total_sub_edges)
+            for vehicle in vehicles for trip in vehicle['tripList']]
+
+def query_rows(edge_list, inter_edges_matrix, edge_index):
+    return get_rows_from_matrix(edge_list, inter_edges_matrix, edge_index)
+
+def run_scale(data_dir, n_queries=1000, seed=0):
+    """
+    Time every stage of the build and query paths on one generated data set.
+    Meant to run in a fresh process (see run_measured) so peak RSS is per scale.
+    """
+    stages = {}
+    json_file = os.path.join(data_dir, 'bus_history.json')
+    tracemalloc.start()
+    try:
+        total_sub_edges = measure_stage(stages, 'load_total_sub_edges', load_total_sub_edges,
+                                        os.path.join(data_dir, 'total_sub_edges'))
+        with open(os.path.join(data_dir, 'total_edges'), 'r') as f:
+            total_edges = json.load(f)
+        edge_index = measure_stage(stages, 'get_edge_index', get_edge_index, total_edges)
+
+        vehicles = measure_stage(stages, 'json_load', load_vehicles, json_file)
+        mapped_trips = measure_stage(stages, 'sub_edge_mapping', map_sub_edges, vehicles, total_sub_edges)
+        edge_freqs = measure_stage(stages, 'process_intermediate_edges', process_trips, vehicles, total_sub_edges)
+        inter_edges_freq = measure_stage(stages, 'merge_edges_frequency', merge_edges_frequency, edge_freqs)
+        inter_edges_matrix = measure_stage(stages, 'create_inter_edges_matrix', create_inter_edges_matrix,
+                                           inter_edges_freq, len(edge_index), edge_index)
+        del edge_freqs, inter_edges_freq
+
+        # Vectorized engine on the same data, end to end
+        vectorized_matrix = measure_stage(stages, 'build_inter_edges_matrix', build_inter_edges_matrix,
+                                          json_file, total_sub_edges, edge_index)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_file = os.path.join(tmp_dir, 'inter_edges_matrix.npz')
+            measure_stage(stages, 'save_npz', sparse.save_npz, tmp_file, inter_edges_matrix)
+            inter_edges_matrix = measure_stage(stages, 'load_npz', sparse.load_npz, tmp_file)
+            matrix_bytes = os.path.getsize(tmp_file)
+
+        edge_list = random.Random(seed).choices(list(edge_index), k=n_queries)
+        measure_stage(stages, 'get_rows_from_matrix', query_rows, edge_list, inter_edges_matrix, edge_index)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'trips': len(mapped_trips),
+        'sub_edges': int(sum(len(trip['edgesOfPath2']) for vehicle in vehicles for trip in vehicle['tripList'])),
+        'mapped_edges': int(sum(len(trip) for trip in mapped_trips)),
+        'edges': len(edge_index),
+        'nnz': int(inter_edges_matrix.nnz),
+        'matrix_bytes': matrix_bytes,
+        'vectorized_parity': int((vectorized_matrix != inter_edges_matrix).nnz) == 0,
+        'queries': n_queries,
+        'stages': stages,
+    }
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark_scales(scales=('small', 'medium'), output_file=None, work_dir=None, seed=0):
+    own_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='edge_matrix_bench_')
+    report = {
+        'commit': get_git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scales': {},
+    }
+    try:
+        for scale in scales:
+            data_dir = os.path.join(work_dir, scale)
+            if not os.path.exists(os.path.join(data_dir, 'bus_history.json')):
+                generate_synthetic_data(data_dir, seed=seed, **SCALES[scale])
+            result = run_measured(run_scale, data_dir)
+            result['config'] = SCALES[scale]
+            report['scales'][scale] = result
+    finally:
+        if own_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if output_file is not None:
+        with open(output_file, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"Save benchmark report to {output_file} successfully")
+    return report
+
+if __name__ == '__main__':
+    report_file = sys.argv[1] if len(sys.argv) > 1 else 'output/benchmark_suite.json'
+    bench_scales = sys.argv[2:] or ['small', 'medium']
+    print(json.dumps(benchmark_scales(bench_scales, report_file), indent=4))
@@ -1,13 +1,27 @@
 import json
+import os
 import pickle
+import shutil
+import tempfile
 import time
+import numpy as np
 from graph import *
+from graph import SUB_EDGES_FORMAT_VERSION
+from metrics import metrics
 from scipy import sparse
 from scipy.sparse import csr_matrix
 from multiprocessing import Pool, cpu_count
-from collections import defaultdict
+from collections import defaultdict, deque
+from functools import lru_cache
+from itertools import islice
 from tqdm import tqdm
 
+try:
+    # Optional fast decoder for bus_history lines (str or bytes), same result as json.loads
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 
 """  
 [module: intermediate_frequency_matrix]
@@ -20,24 +34,33 @@ edges in the matrix and save it to file.
 # Task 3.2 + 3.3
 json_file = 'jsonFiles/bus_history.json'
 matrix_file = 'output/inter_edges_matrix.npz'
+top_k_file = 'output/inter_edges_top_k.npz'
 index_file = 'output/edge_index.pkl'
 osm_file = "osmFiles/HoChiMinh.osm"
 total_sub_edges_file = "output/total_sub_edges"
+sub_edges_dir = "output/sub_edges"
 
 def default_factory():
     return defaultdict(int)
 
-def process_intermediate_edges(trip, total_sub_edges):
+def process_intermediate_edges(trip, total_sub_edges, windows=10, dedupe='global'):
     edge_freq = defaultdict(default_factory)
     sub_edges = trip['edgesOfPath2']
 
     # Map to edge: connection between two intersections
+    # dedupe='global' keeps the first visit of each edge, 'consecutive' only
+    # collapses runs of sub-edges on the same edge (loops are kept)
     edges = []
+    seen = set()
     for sub_edge in sub_edges:
         if tuple(sub_edge) not in total_sub_edges:
             continue
         edge = total_sub_edges[tuple(sub_edge)]
-        if edge not in edges:
+        if dedupe == 'consecutive':
+            if not edges or edges[-1] != edge:
+                edges.append(edge)
+        elif edge not in seen:
+            seen.add(edge)
             edges.append(edge)
     n = len(edges)
 
@@ -61,7 +84,8 @@ def process_intermediate_edges(trip, total_sub_edges):
     #             edge_freq[(edge_i, edge_j)][intermediate_edge] += 1
                 
     # O(N * Windows) (Average case), O(N * Windows^2) (Worst case) (Sliding Windows + Prefix Sum)
-    windows = 10 # Can be enlarged (based on computer's cpu performance)
+    # windows can be enlarged (based on computer's cpu performance), None = whole trip
+    windows = n if windows is None else windows
     for i in range(n):
         edge_i = edges[i]
         inter_counts = defaultdict(int)
@@ -76,6 +100,10 @@ def process_intermediate_edges(trip, total_sub_edges):
         
     return {k: dict(v) for k, v in edge_freq.items()}
 
+def process_intermediate_edges_task(task):
+    return process_intermediate_edges(*task)
+
+@metrics.timed('merge_edges_frequency')
 def merge_edges_frequency(edge_freqs_list):
     merged_freq = defaultdict(lambda: defaultdict(int))
     for edge_freq in edge_freqs_list:
@@ -85,22 +113,650 @@ def merge_edges_frequency(edge_freqs_list):
                 #print(f"From {edge_i} to {edge_j} : {intermediate_edge, count}")
     return merged_freq
 
-def parse_raw_data(json_file, total_sub_edges):
+# Vectorized engine: trips are encoded to dense edge indices (edge_index)
+# and every (i, j, k) triple of a trip is emitted at once with NumPy, then
+# grouped with np.unique instead of nested dicts.
+def get_sub_edge_index(total_sub_edges, edge_index):
+    # Map each sub-edge directly to the matrix index of its edge
+    if isinstance(edge_index, EdgeIndexArrays):
+        indices = edge_index.to_indices(np.fromiter(total_sub_edges.values(), dtype=np.int64,
+                                                    count=len(total_sub_edges)))
+        return {sub_edge: index for sub_edge, index in zip(total_sub_edges, indices.tolist()) if index}
+    return {sub_edge: edge_index[str(edge)] for sub_edge, edge in total_sub_edges.items()}
+
+DEDUPE_MODES = ('global', 'consecutive')
+
+def map_trip(trip, sub_edge_index):
+    # Matrix indices of the trip's mapped sub-edges (unmapped ones dropped) and the sub-edge count
+    # `trip` is a bus_history trip dict or an (n, 2) node array from the trip store
+    sub_edges = trip['edgesOfPath2'] if isinstance(trip, dict) else trip
+    if isinstance(sub_edge_index, SubEdgeLookup):
+        edges = sub_edge_index.edge_indices(sub_edges)
+        edges = edges[edges > 0]
+    else:
+        if isinstance(sub_edges, np.ndarray):
+            sub_edges = [tuple(map(str, sub_edge)) for sub_edge in sub_edges.tolist()]
+        edges = [sub_edge_index[tuple(sub_edge)] for sub_edge in sub_edges 
+                 if tuple(sub_edge) in sub_edge_index]
+        edges = np.array(edges, dtype=np.int32)
+    return edges, len(sub_edges)
+
+def encode_trip(trip, sub_edge_index, dedupe='global'):
+    return dedupe_edges(map_trip(trip, sub_edge_index)[0], dedupe)
+
+def dedupe_edges(edges, dedupe='global'):
+    if dedupe == 'consecutive':
+        # Collapse runs of sub-edges on the same edge, revisits stay
+        keep = np.ones(len(edges), dtype=bool)
+        keep[1:] = edges[1:] != edges[:-1]
+        return edges[keep]
+    if dedupe != 'global':
+        raise ValueError(f"Unknown dedupe mode {dedupe!r}, expected one of {DEDUPE_MODES}")
+    
+    # Keep the first occurrence of each edge (same as `if edge not in edges`)
+    _, first = np.unique(edges, return_index=True)
+    return edges[np.sort(first)]
+
+def make_window_offsets(windows):
+    # (j - i, k - i) for i < k < j <= i + windows, in the order the dict version visits them
+    d = np.repeat(np.arange(2, windows + 1, dtype=np.int64), np.arange(1, max(windows, 1), dtype=np.int64))
+    e = np.arange(len(d), dtype=np.int64) - np.repeat(np.cumsum(np.arange(0, max(windows - 1, 0))),
+                                                      np.arange(1, max(windows, 1))) + 1
+    return np.stack([d, e], axis=1)
+
+@lru_cache(maxsize=None)
+def get_window_offsets(windows):
+    offsets = make_window_offsets(windows)
+    offsets.flags.writeable = False
+    return offsets
+
+# Windows up to this size keep their offsets cached; larger ones are built per
+# trip. Trips with repeated edges and a larger window go through the
+# prefix-count emitter below, trips of distinct edges emit directly in blocks of i.
+DIRECT_WINDOW_LIMIT = 16
+
+def count_window_pairs(n, windows):
+    # (i, j) pairs with 2 <= j - i <= windows in a trip of n edges
+    d = np.arange(2, n if windows is None else min(windows, n - 1) + 1, dtype=np.int64)
+    return int((n - d).sum())
+
+def count_window_triples(n, windows):
+    # Triples emitted by a trip of n edges: sum over d = j - i of (n - d) * (d - 1)
+    d = np.arange(2, n if windows is None else min(windows, n - 1) + 1, dtype=np.int64)
+    return int(((n - d) * (d - 1)).sum())
+
+def get_trip_window(n, windows=10, max_triples=None):
+    """
+    Window used for a trip of n edges. `windows=None` is unbounded (every
+    j > i + 1 of the trip); `max_triples` shrinks the window of long trips
+    so they emit at most that many triples.
+    """
+    window = n - 1 if windows is None else min(windows, n - 1)
+    if max_triples is not None and window >= 2:
+        d = np.arange(2, window + 1, dtype=np.int64)
+        fits = np.searchsorted(np.cumsum((n - d) * (d - 1)), max_triples, side='right')
+        window = max(int(fits) + 1, 1)
+    return window
+
+def emit_triples(edges, offsets, start=0, stop=None):
+    # Triples of the positions i in [start, stop)
+    n = len(edges)
+    i = np.arange(start, n if stop is None else stop, dtype=np.int64)[:, None]
+    j = i + offsets[:, 0]
+    k = i + offsets[:, 1]
+    
+    # Row-major masking keeps (i, j, k) in lexicographic order
+    valid = j < n
+    i = np.broadcast_to(i, valid.shape)[valid]
+    return edges[i], edges[j[valid]], edges[k[valid]]
+
+def emit_window_triples(edges, window, block_size=1 << 22):
+    # emit_triples over blocks of i, so the (i, offset) masks stay around block_size entries
+    offsets = get_window_offsets(window) if window <= DIRECT_WINDOW_LIMIT else make_window_offsets(window)
+    n = len(edges)
+    step = max(1, block_size // max(len(offsets), 1))
+    if n <= step:
+        return emit_triples(edges, offsets)
+    blocks = [emit_triples(edges, offsets, start, min(start + step, n)) for start in range(0, n, step)]
+    return tuple(np.concatenate(column) for column in zip(*blocks))
+
+def emit_weighted_triples(edges, window, block_size=1 << 22):
+    """
+    Emit (edge_i, edge_j, intermediate, count) for i < k < j <= i + window
+    without one record per (i, j, k): an intermediate repeated inside (i, j)
+    is emitted once, at its first position after i, with the number of times
+    it occurs there (taken from per-edge prefix counts of the trip).
+    Records come out in (i, j, k) order like emit_triples.
+    """
+    n = len(edges)
+    positions = np.arange(n, dtype=np.int64)
+    
+    # Group positions by edge: prev = previous position of the same edge,
+    # rank = occurrences of the edge before this position
+    order = np.lexsort((positions, edges))
+    new_group = np.ones(n, dtype=bool)
+    new_group[1:] = edges[order[1:]] != edges[order[:-1]]
+    group_start = np.maximum.accumulate(np.where(new_group, positions, 0))
+    prev = np.full(n, -1, dtype=np.int64)
+    prev[order[1:][~new_group[1:]]] = order[:-1][~new_group[1:]]
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = positions - group_start
+    group = np.empty(n, dtype=np.int64)
+    group[order] = np.cumsum(new_group) - 1
+    occurrence_keys = group[order] * (n + 1) + order
+    group_offset = np.empty(n, dtype=np.int64)
+    group_offset[order] = group_start
+    
+    # (i, k) with k the first position of edges[k] after i, then every j > k in the window
+    steps = np.arange(1, max(window, 1), dtype=np.int64)
+    ii = np.repeat(positions, len(steps))
+    kk = ii + np.tile(steps, n)
+    valid = kk < n - 1
+    ii, kk = ii[valid], kk[valid]
+    valid = prev[kk] <= ii
+    ii, kk = ii[valid], kk[valid]
+    lengths = np.minimum(ii + window, n - 1) - kk
+    
+    # Expand in blocks of whole i's so an unbounded window never materializes everything at once
+    per_i = np.cumsum(np.bincount(ii, weights=lengths, minlength=n))
+    cut_i = np.unique(np.searchsorted(per_i, np.arange(block_size, per_i[-1] if n else 0, block_size)))
+    bounds = np.concatenate([[0], np.searchsorted(ii, cut_i + 1), [len(ii)]]).astype(np.int64)
+    
+    result = ([], [], [], [])
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if lo == hi:
+            continue
+        block_lengths = lengths[lo:hi]
+        i = np.repeat(ii[lo:hi], block_lengths)
+        k = np.repeat(kk[lo:hi], block_lengths)
+        j = k + 1 + np.arange(len(k)) - np.repeat(np.cumsum(block_lengths) - block_lengths, block_lengths)
+        
+        # Occurrences of edges[k] before j, minus the ones before k
+        count = np.searchsorted(occurrence_keys, group[k] * (n + 1) + j) - group_offset[k] - rank[k]
+        block_order = np.lexsort((k, j, i))
+        for column, values in zip(result, (edges[i], edges[j], edges[k], count)):
+            column.append(values[block_order])
+    
+    if not result[0]:
+        empty = edges[:0]
+        return empty, empty, empty, np.empty(0, dtype=np.int64)
+    return tuple(np.concatenate(column) for column in result)
+
+def encode_triples(edge_i, edge_j, inter, edge_size):
+    size = edge_size + 1
+    return (edge_i.astype(np.int64) * size + edge_j) * size + inter
+
+def get_trip_keys(edges, edge_size, windows=10, max_triples=None):
+    # Triple keys of one encoded trip and their counts (None when every count is 1)
+    window = get_trip_window(len(edges), windows, max_triples)
+    # Prefix counts only pay off when an intermediate can repeat inside a window
+    if window > DIRECT_WINDOW_LIMIT and len(np.unique(edges)) < len(edges):
+        edge_i, edge_j, inter, counts = emit_weighted_triples(edges, window)
+        return encode_triples(edge_i, edge_j, inter, edge_size), counts
+    return encode_triples(*emit_window_triples(edges, window), edge_size), None
+
+def get_triple_keys(encoded_trips, edge_size, windows=10, max_triples=None):
+    trip_keys = [get_trip_keys(edges, edge_size, windows, max_triples) for edges in encoded_trips]
+    if not trip_keys:
+        return np.empty(0, dtype=np.int64), None
+    keys = np.concatenate([keys for keys, _ in trip_keys])
+    if all(counts is None for _, counts in trip_keys):
+        return keys, None
+    counts = np.concatenate([np.ones(len(keys), dtype=np.int64) if counts is None else counts
+                             for keys, counts in trip_keys])
+    return keys, counts
+
+def count_triple_keys(keys, base=0, weights=None):
+    # `base` is the number of triples emitted before these keys (global emission order)
+    if weights is None:
+        keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        return keys, counts.astype(np.int64), first.astype(np.int64) + base
+    return reduce_counts(keys, weights.astype(np.int64), np.arange(len(keys), dtype=np.int64) + base)
+
+def count_intermediate_edges(encoded_trips, edge_size, windows=10, max_triples=None):
+    """
+    Count every (edge_i, edge_j, intermediate) triple of the encoded trips.
+    Returns the unique triple keys, their counts and the position where each
+    key was first emitted (used to break ties like the dict version does).
+    """
+    keys, weights = get_triple_keys(encoded_trips, edge_size, windows, max_triples)
+    return count_triple_keys(keys, weights=weights)
+
+def reduce_counts(keys, counts, first):
+    # Group equal keys: counts are summed, the earliest emission is kept
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    head = np.ones(len(keys), dtype=bool)
+    head[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(head)
+    
+    if len(starts) == 0:
+        return keys, counts[:0], first[:0]
+    return keys[starts], np.add.reduceat(counts[order], starts), np.minimum.reduceat(first[order], starts)
+
+def select_most_frequent(keys, counts, first, edge_size):
+    size = edge_size + 1
+    pairs = keys // size
+    inters = keys % size
+    
+    # Highest count first; on a tie the intermediate seen first wins (dict order of max())
+    order = np.lexsort((first, -counts, pairs))
+    pairs = pairs[order]
+    inters = inters[order]
+    head = np.ones(len(pairs), dtype=bool)
+    head[1:] = pairs[1:] != pairs[:-1]
+    
+    pairs = pairs[head]
+    return pairs // size, pairs % size, inters[head]
+
+def create_inter_edges_matrix_from_counts(keys, counts, first, edge_size):
+    rows, cols, inters = select_most_frequent(keys, counts, first, edge_size)
+    inter_edges_matrix = sparse.csr_matrix((inters.astype(np.int32), (rows, cols)), shape=(edge_size+1, edge_size+1))
+    
+    return inter_edges_matrix
+
+def load_encoded_trips(json_file, sub_edge_index, dedupe='global'):
+    encoded_trips = []
+    with open(json_file, 'r') as f:
+        for line in f:
+            vehicle = json.loads(line.strip())
+            for trip in vehicle['tripList']:
+                encoded_trips.append(encode_trip(trip, sub_edge_index, dedupe))
+                
+    print(f"Encoded {len(encoded_trips)} trips from {json_file}")
+    return encoded_trips
+
+def build_inter_edges_matrix(json_file, total_sub_edges, edge_index, windows=10, max_triples=None,
+                             dedupe='global'):
+    sub_edge_index = get_sub_edge_index(total_sub_edges, edge_index)
+    with metrics.stage('encode_trips'):
+        encoded_trips = load_encoded_trips(json_file, sub_edge_index, dedupe)
+        metrics.count('trips', len(encoded_trips))
+    with metrics.stage('count_triples'):
+        keys, counts, first = count_intermediate_edges(encoded_trips, len(edge_index), windows, max_triples)
+        metrics.count('triples', counts.sum())
+    with metrics.stage('select_most_frequent'):
+        return create_inter_edges_matrix_from_counts(keys, counts, first, len(edge_index))
+
+# Streaming build: trips are read lazily, counted per chunk and kept as
+# partial COO runs (packed (row, col, intermediate) key, count, first seen).
+# Runs spill to disk once they pass the memory budget and are k-way merged
+# at the end, so peak memory no longer grows with the size of the history.
+def iter_trips(json_file):
+    with open(json_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            vehicle = json.loads(line)
+            for trip in vehicle['tripList']:
+                yield trip
+
+def iter_encoded_chunks(trips, sub_edge_index, chunk_size=1000, dedupe='global'):
+    chunk = []
+    for trip in trips:
+        chunk.append(encode_trip(trip, sub_edge_index, dedupe))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class PartialCounts:
+    def __init__(self, memory_budget=512 * 1024 * 1024, spill_dir=None):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.run_dir = None
+        self.partials = []
+        self.memory = 0
+        self.runs = []
+        self.emitted = 0
+
+    def add_keys(self, keys, weights=None):
+        self.add(*count_triple_keys(keys, self.emitted, weights))
+        self.emitted += len(keys)
+
+    def add(self, keys, counts, first):
+        self.partials.append((keys, counts, first))
+        self.memory += keys.nbytes + counts.nbytes + first.nbytes
+        if self.memory > self.memory_budget:
+            self.spill()
+
+    def reduce_partials(self):
+        if not self.partials:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        keys, counts, first = (np.concatenate(column) for column in zip(*self.partials))
+        return reduce_counts(keys, counts, first)
+
+    def spill(self):
+        # Runs go to a private directory (under spill_dir if given), so several
+        # PartialCounts can share one spill_dir without overwriting each other
+        if self.run_dir is None:
+            if self.spill_dir is not None:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            self.run_dir = tempfile.mkdtemp(prefix='inter_edges_', dir=self.spill_dir)
+        
+        run = os.path.join(self.run_dir, f"run_{len(self.runs)}")
+        for name, column in zip(('keys', 'counts', 'first'), self.reduce_partials()):
+            np.save(f"{run}_{name}.npy", column)
+        self.runs.append(run)
+        self.partials = []
+        self.memory = 0
+
+    def load_runs(self):
+        runs = [tuple(np.load(f"{run}_{name}.npy", mmap_mode='r') for name in ('keys', 'counts', 'first'))
+                for run in self.runs]
+        if self.partials:
+            runs.append(self.reduce_partials())
+        return runs
+
+    def cleanup(self):
+        if self.run_dir is not None:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+        self.run_dir = None
+        self.runs = []
+
+def merge_count_runs(runs, edge_size, block_size=1 << 22):
+    """
+    K-way merge of sorted count runs. Blocks are cut on pair boundaries so each
+    (edge_i, edge_j) sees all of its intermediates; yields reduced
+    (keys, counts, first) blocks.
+    """
+    size = edge_size + 1
+    positions = [0] * len(runs)
+    
+    while any(pos < len(run[0]) for run, pos in zip(runs, positions)):
+        bound = None
+        for (keys, _, _), pos in zip(runs, positions):
+            if pos + block_size < len(keys):
+                pair = int(keys[pos + block_size]) // size
+                bound = pair if bound is None else min(bound, pair)
+        
+        if bound is None:
+            ends = [len(keys) for keys, _, _ in runs]
+        else:
+            ends = [int(np.searchsorted(keys, bound * size)) for keys, _, _ in runs]
+            if ends == positions:
+                # One pair is larger than a block, take it whole
+                ends = [int(np.searchsorted(keys, (bound + 1) * size)) for keys, _, _ in runs]
+        
+        block = [np.concatenate([np.asarray(run[c][pos:end]) for run, pos, end in zip(runs, positions, ends)])
+                 for c in range(3)]
+        positions = ends
+        yield reduce_counts(*block)
+
+@metrics.timed('merge_runs')
+def create_inter_edges_matrix_from_runs(runs, edge_size):
+    rows, cols, inters = [], [], []
+    for block in merge_count_runs(runs, edge_size):
+        block_rows, block_cols, block_inters = select_most_frequent(*block, edge_size)
+        rows.append(block_rows)
+        cols.append(block_cols)
+        inters.append(block_inters.astype(np.int32))
+    
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int64)
+    inters = np.concatenate(inters) if inters else np.empty(0, dtype=np.int32)
+    inter_edges_matrix = sparse.csr_matrix((inters, (rows, cols)), shape=(edge_size+1, edge_size+1))
+    
+    return inter_edges_matrix
+
+def build_inter_edges_matrix_streaming(json_file, total_sub_edges, edge_index, windows=10,
+                                       chunk_size=1000, memory_budget=512 * 1024 * 1024, spill_dir=None,
+                                       max_triples=None, dedupe='global'):
+    # `json_file` is a JSON lines file or a vehicle.VehicleQuery view (trips read from its trip store)
+    edge_size = len(edge_index)
+    sub_edge_index = get_sub_edge_index(total_sub_edges, edge_index)
+    partial_counts = PartialCounts(memory_budget, spill_dir)
+    trips = json_file.iterTripEdges() if hasattr(json_file, 'iterTripEdges') else iter_trips(json_file)
+    
+    try:
+        trip_count = 0
+        with metrics.stage('count_triples'):
+            for chunk in iter_encoded_chunks(trips, sub_edge_index, chunk_size, dedupe):
+                keys, weights = get_triple_keys(chunk, edge_size, windows, max_triples)
+                partial_counts.add_keys(keys, weights)
+                trip_count += len(chunk)
+                metrics.count('trips', len(chunk))
+                metrics.count('triples', len(keys) if weights is None else weights.sum())
+        print(f"Processed {trip_count} trips ({len(partial_counts.runs)} spilled runs)")
+        
+        return create_inter_edges_matrix_from_runs(partial_counts.load_runs(), edge_size)
+    finally:
+        partial_counts.cleanup()
+
+def build_inter_edges_matrix_from_query(vehicle_query, total_sub_edges, edge_index, windows=10, chunk_size=1000,
+                                        memory_budget=512 * 1024 * 1024, spill_dir=None, max_triples=None,
+                                        dedupe='global'):
+    # Matrix of the trips selected by a VehicleQuery view (e.g. one route), without re-parsing the JSON
+    return build_inter_edges_matrix_streaming(vehicle_query, total_sub_edges, edge_index, windows, chunk_size,
+                                              memory_budget, spill_dir, max_triples, dedupe)
+
+# Worker pool: the sub-edge lookup reaches each process once through the pool
+# initializer instead of being pickled with every trip. Workers get chunks of
+# raw JSON lines and send back one partial count per chunk.
+CHUNK_ORDER_BITS = 40
+_worker_state = {}
+
+def init_worker(sub_edge_index, edge_size, windows, max_triples=None, dedupe='global'):
+    # A bundle directory is memory-mapped, so all workers share the same pages
+    if isinstance(sub_edge_index, str):
+        sub_edge_index = SubEdgeLookup(sub_edge_index)
+    _worker_state['sub_edge_index'] = sub_edge_index
+    _worker_state['edge_size'] = edge_size
+    _worker_state['windows'] = windows
+    _worker_state['max_triples'] = max_triples
+    _worker_state['dedupe'] = dedupe
+
+def process_trip_chunk(chunk_id, lines):
+    sub_edge_index = _worker_state['sub_edge_index']
+    windows = _worker_state['windows']
+    max_triples = _worker_state['max_triples']
+    
+    # Counters travel back with the result, so the parent reports real progress
+    # `lines` are str (iter_line_chunks) or bytes (ingest byte ranges)
+    counters = {'json_bytes': sum(len(line.encode()) if isinstance(line, str) else len(line) for line in lines),
+                'sub_edges': 0, 'unmapped_sub_edges': 0, 'pairs': 0}
+    encoded_trips = []
+    for line in lines:
+        for trip in json_loads(line)['tripList']:
+            edges, n_sub_edges = map_trip(trip, sub_edge_index)
+            counters['sub_edges'] += n_sub_edges
+            counters['unmapped_sub_edges'] += n_sub_edges - len(edges)
+            encoded_trips.append(dedupe_edges(edges, _worker_state['dedupe']))
+    keys, weights = get_triple_keys(encoded_trips, _worker_state['edge_size'], windows, max_triples)
+    counters['trips'] = len(encoded_trips)
+    counters['triples'] = len(keys) if weights is None else int(weights.sum())
+    counters['pairs'] = sum(count_window_pairs(len(edges), get_trip_window(len(edges), windows, max_triples))
+                            for edges in encoded_trips)
+    
+    # Chunk id in the high bits keeps the first-seen order global across workers
+    return count_triple_keys(keys, chunk_id << CHUNK_ORDER_BITS, weights), counters
+
+def iter_line_chunks(json_file, chunk_size=50):
+    chunk = []
+    with open(json_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+def collect_ready(pending, collect, max_pending=0):
+    """
+    Collect pool results in the order they finish, waiting only while more
+    than max_pending are still in flight. `pending` is a list of
+    (AsyncResult, *args) and collect(result, *args) returns a trip count.
+    Chunk ids travel with the counts, so the collection order never changes ties.
+    """
+    trips = 0
+    while pending:
+        finished = [entry for entry in pending if entry[0].ready()]
+        if not finished:
+            if len(pending) <= max_pending:
+                break
+            pending[0][0].wait(0.05)
+            continue
+        for entry in finished:
+            pending.remove(entry)
+            trips += collect(*entry)
+    return trips
+
+def collect_trip_chunk(result, partial_counts, progress=None):
+    (keys, counts, first), counters = result.get()
+    partial_counts.add(keys, counts, first)
+    metrics.add_counts(counters)
+    if progress is not None:
+        progress.update(counters['json_bytes'])
+    return counters['trips']
+
+def count_inter_edges_parallel(json_file, total_sub_edges, edge_index, windows=10, chunk_size=50,
+                               processes=None, memory_budget=512 * 1024 * 1024, spill_dir=None,
+                               max_triples=None, dedupe='global'):
+    # Returns the PartialCounts of the whole file, the caller merges and cleans them up
+    edge_size = len(edge_index)
+    if isinstance(total_sub_edges, str):
+        # Path of a sub_edges bundle, opened by each worker
+        SubEdgeLookup(total_sub_edges).check_edge_index(edge_index)
+        sub_edge_index = total_sub_edges
+    else:
+        sub_edge_index = get_sub_edge_index(total_sub_edges, edge_index)
+    partial_counts = PartialCounts(memory_budget, spill_dir)
+    
+    try:
+        trip_count = 0
+        processes = processes or cpu_count()
+        # Progress advances when a worker finishes a chunk, by the bytes of JSON it processed
+        with metrics.stage('count_triples'), \
+                tqdm(total=os.path.getsize(json_file), unit='B', unit_scale=True, desc='count_triples') as progress, \
+                Pool(processes, initializer=init_worker,
+                     initargs=(sub_edge_index, edge_size, windows, max_triples, dedupe)) as pool:
+            # Only a few chunks in flight, so the raw file is never held in memory at once
+            pending = []
+            collect = lambda result: collect_trip_chunk(result, partial_counts, progress)
+            for task in enumerate(iter_line_chunks(json_file, chunk_size)):
+                pending.append((pool.apply_async(process_trip_chunk, task),))
+                trip_count += collect_ready(pending, collect, 2 * processes - 1)
+            trip_count += collect_ready(pending, collect)
+        print(f"Processed {trip_count} trips")
+    except BaseException:
+        partial_counts.cleanup()
+        raise
+    
+    return partial_counts
+
+def build_inter_edges_matrix_parallel(json_file, total_sub_edges, edge_index, windows=10, chunk_size=50,
+                                      processes=None, memory_budget=512 * 1024 * 1024, spill_dir=None,
+                                      max_triples=None, dedupe='global'):
+    partial_counts = count_inter_edges_parallel(json_file, total_sub_edges, edge_index, windows, chunk_size,
+                                                processes, memory_budget, spill_dir, max_triples, dedupe)
+    try:
+        return create_inter_edges_matrix_from_runs(partial_counts.load_runs(), len(edge_index))
+    finally:
+        partial_counts.cleanup()
+
+# Top-K mode: keep the K most frequent intermediates of every pair with their
+# counts, in a ragged layout (pair i owns inters[offsets[i]:offsets[i+1]]).
+def select_top_k(keys, counts, first, edge_size, k=5):
+    size = edge_size + 1
+    pairs = keys // size
+    
+    # Rank inside each pair segment, same ordering (and tie-break) as the argmax
+    order = np.lexsort((first, -counts, pairs))
+    pairs = pairs[order]
+    inters = keys[order] % size
+    counts = counts[order]
+    head = np.ones(len(pairs), dtype=bool)
+    head[1:] = pairs[1:] != pairs[:-1]
+    starts = np.flatnonzero(head)
+    rank = np.arange(len(pairs)) - np.repeat(starts, np.diff(np.append(starts, len(pairs))))
+    
+    totals = np.add.reduceat(counts, starts) if len(starts) else counts[:0]
+    keep = rank < k
+    return {
+        'pair_keys': pairs[starts],
+        'lengths': np.bincount(np.cumsum(head)[keep] - 1, minlength=len(starts)),
+        'inters': inters[keep],
+        'counts': counts[keep],
+        'totals': totals,
+    }
+
+def finish_top_k(blocks, edge_size, k):
+    # Concatenate select_top_k blocks into the stored layout (lengths -> offsets)
+    top_k = {name: np.concatenate([block[name] for block in blocks]) if blocks else np.empty(0, dtype=np.int64)
+             for name in ('pair_keys', 'lengths', 'inters', 'counts', 'totals')}
+    
+    offsets = np.zeros(len(top_k['lengths']) + 1, dtype=np.int64)
+    np.cumsum(top_k.pop('lengths'), out=offsets[1:])
+    top_k['offsets'] = offsets
+    top_k['pair_keys'] = top_k['pair_keys'].astype(np.int64)
+    top_k['inters'] = top_k['inters'].astype(np.int32)
+    # Decayed weights (incremental updates) are rounded to whole counts
+    top_k['counts'] = np.rint(top_k['counts']).astype(np.uint32)
+    top_k['totals'] = np.rint(top_k['totals']).astype(np.uint32)
+    top_k['edge_size'] = np.int64(edge_size)
+    top_k['k'] = np.int64(k)
+    return top_k
+
+@metrics.timed('merge_runs')
+def create_top_k_from_runs(runs, edge_size, k=5):
+    blocks = [select_top_k(*block, edge_size, k) for block in merge_count_runs(runs, edge_size)]
+    return finish_top_k(blocks, edge_size, k)
+
+def build_top_k_inter_edges(json_file, total_sub_edges, edge_index, k=5, windows=10, chunk_size=50,
+                            processes=None, memory_budget=512 * 1024 * 1024, spill_dir=None, max_triples=None,
+                            dedupe='global'):
+    partial_counts = count_inter_edges_parallel(json_file, total_sub_edges, edge_index, windows, chunk_size,
+                                                processes, memory_budget, spill_dir, max_triples, dedupe)
+    try:
+        return create_top_k_from_runs(partial_counts.load_runs(), len(edge_index), k)
+    finally:
+        partial_counts.cleanup()
+
+def save_top_k(top_k_file, top_k):
+    np.savez(top_k_file, **top_k)
+    print("Save top_k successfully")
+
+def load_top_k(top_k_file):
+    with np.load(top_k_file) as f:
+        top_k = {name: f[name] for name in f.files}
+    print("Load top_k successfully")
+    return top_k
+
+def check_matrix_parity(json_file, total_sub_edges, edge_index, windows=10, dedupe='global'):
+    # Parity check of the vectorized engine against the dict-based path
+    edge_size = len(edge_index)
+    inter_edges_freq = merge_edges_frequency(parse_raw_data(json_file, total_sub_edges, windows, dedupe))
+    expected = create_inter_edges_matrix(inter_edges_freq, edge_size, edge_index)
+    result = build_inter_edges_matrix(json_file, total_sub_edges, edge_index, windows, dedupe=dedupe)
+    
+    mismatches = (expected != result).nnz
+    print(f"Parity check: {mismatches} mismatched entries")
+    return mismatches == 0
+
+def parse_raw_data(json_file, total_sub_edges, windows=10, dedupe='global'):
     data = []
 
     try:
-        with open(json_file, 'r') as f:
-            for line in f:
-                data.append(json.loads(line.strip()))
+        with metrics.stage('json_load'):
+            with open(json_file, 'r') as f:
+                for line in f:
+                    data.append(json.loads(line.strip()))
 
         print(f"Loaded {len(data)} vehicles from {json_file}")
         
         # Process the trips in parallel
-        with Pool(cpu_count()) as pool:
+        with metrics.stage('process_intermediate_edges'), Pool(cpu_count()) as pool:
             try:
-              
-                trip_edges_freq = pool.starmap(process_intermediate_edges, 
-                                               [(trip, total_sub_edges) for vehicle in tqdm(data) for trip in vehicle['tripList']])
+                # tqdm follows the results coming back, not the list of arguments being built
+                tasks = [(trip, total_sub_edges, windows, dedupe) for vehicle in data for trip in vehicle['tripList']]
+                trip_edges_freq = list(tqdm(pool.imap(process_intermediate_edges_task, tasks, chunksize=16),
+                                            total=len(tasks), desc='process_intermediate_edges'))
+                metrics.count('trips', len(trip_edges_freq))
 
                 print(f"Processed {len(trip_edges_freq)} trips")
 
@@ -129,12 +785,16 @@ def get_edge_index(total_edges):
     return edge_index
 
 def from_index_to_edge(total_edges, index):
-    edge_index = load_edge_index(index_file)
-    for edge in total_edges:
-        if edge_index[edge] == index:
-            return edge
+    # edge_index numbers total_edges in order, so the saved reverse array answers directly
+    edge_index_dir = get_edge_index_dir(index_file)
+    if os.path.exists(os.path.join(edge_index_dir, 'manifest.json')):
+        way = int(get_cached_edge_index_arrays(edge_index_dir).to_way_ids(index))
+        return str(way) if way != -1 else None
+    if 1 <= index <= len(total_edges):
+        return next(islice(iter(total_edges), index - 1, None))
     return None
     
+@metrics.timed('create_inter_edges_matrix')
 def create_inter_edges_matrix(edge_freq, edge_size, edge_index):
     row_indices = []
     col_indices = []
@@ -166,6 +826,8 @@ def load_inter_edges_matrix(matrix_file):
 def save_edge_index(index_file, edge_index):
     with open(index_file, 'wb') as f:
         pickle.dump(edge_index, f)
+    # Array form next to the pickle (output/edge_index.pkl -> output/edge_index/)
+    save_edge_index_arrays(edge_index, get_edge_index_dir(index_file))
     print("Save edge_index successfully")
 
 def load_edge_index(index_file):
@@ -174,6 +836,106 @@ def load_edge_index(index_file):
     print("Load edge_index successfully")
     return edge_index
 
+EDGE_INDEX_FORMAT_VERSION = 1
+
+def get_edge_index_dir(index_file):
+    return os.path.splitext(index_file)[0]
+
+class EdgeIndexArrays:
+    """
+    edge_index as arrays: index_to_way[i] is the way id of matrix index i
+    (-1 at 0), and sorted_way_ids / sorted_positions map way ids back to
+    indices with one searchsorted. Both directions decode whole columns.
+    Also answers the dict interface (edge_index[str(way_id)], in, items).
+    """
+    def __init__(self, index_to_way, sorted_way_ids, sorted_positions):
+        self.index_to_way = index_to_way
+        self.sorted_way_ids = sorted_way_ids
+        self.sorted_positions = sorted_positions
+
+    @classmethod
+    def from_edge_index(cls, edge_index):
+        way_ids = np.array([int(edge) for edge in edge_index], dtype=np.int64)
+        positions = np.array(list(edge_index.values()), dtype=np.int64)
+        index_to_way = np.full(len(edge_index) + 1, -1, dtype=np.int64)
+        index_to_way[positions] = way_ids
+        order = np.argsort(way_ids, kind='stable')
+        return cls(index_to_way, way_ids[order], positions[order])
+
+    def __len__(self):
+        return len(self.index_to_way) - 1
+
+    def to_indices(self, way_ids):
+        # Matrix index of every way id, 0 if the way is not indexed
+        way_ids = np.asarray(way_ids, dtype=np.int64)
+        if len(self.sorted_way_ids) == 0:
+            return np.zeros(way_ids.shape, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_way_ids, way_ids), len(self.sorted_way_ids) - 1)
+        return np.where(self.sorted_way_ids[pos] == way_ids, self.sorted_positions[pos], 0)
+
+    def to_way_ids(self, indices):
+        # Way id of every matrix index, -1 for 0 / unknown
+        indices = np.asarray(indices, dtype=np.int64)
+        valid = (indices > 0) & (indices < len(self.index_to_way))
+        return np.where(valid, self.index_to_way[np.where(valid, indices, 0)], -1)
+
+    def get(self, edge, default=None):
+        index = int(self.to_indices(int(edge)))
+        return index if index else default
+
+    def __getitem__(self, edge):
+        index = self.get(edge)
+        if index is None:
+            raise KeyError(edge)
+        return index
+
+    def __contains__(self, edge):
+        return self.get(edge) is not None
+
+    def __iter__(self):
+        return (str(way) for way in self.index_to_way[1:].tolist())
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return range(1, len(self) + 1)
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+def save_edge_index_arrays(edge_index, dirname):
+    if not isinstance(edge_index, EdgeIndexArrays):
+        edge_index = EdgeIndexArrays.from_edge_index(edge_index)
+    os.makedirs(dirname, exist_ok=True)
+    np.save(os.path.join(dirname, 'index_to_way.npy'), edge_index.index_to_way)
+    np.save(os.path.join(dirname, 'sorted_way_ids.npy'), edge_index.sorted_way_ids)
+    np.save(os.path.join(dirname, 'sorted_positions.npy'), edge_index.sorted_positions)
+    with open(os.path.join(dirname, 'manifest.json'), 'w') as f:
+        json.dump({'format': 'edge_index', 'version': EDGE_INDEX_FORMAT_VERSION, 'edges': len(edge_index)}, f)
+
+def load_edge_index_arrays(dirname, mmap_mode='r'):
+    with open(os.path.join(dirname, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('format') != 'edge_index' or manifest.get('version') != EDGE_INDEX_FORMAT_VERSION:
+        raise ValueError(f"Unsupported edge_index arrays in {dirname}: {manifest}")
+    
+    edge_index = EdgeIndexArrays(*(np.load(os.path.join(dirname, f"{name}.npy"), mmap_mode=mmap_mode)
+                                   for name in ('index_to_way', 'sorted_way_ids', 'sorted_positions')))
+    print("Load edge_index arrays successfully")
+    return edge_index
+
+def open_edge_index(index_file):
+    # Array form of edge_index: the saved (mmap) arrays if present, else built from the pickle
+    edge_index_dir = get_edge_index_dir(index_file)
+    if os.path.exists(os.path.join(edge_index_dir, 'manifest.json')):
+        return load_edge_index_arrays(edge_index_dir)
+    return EdgeIndexArrays.from_edge_index(load_edge_index(index_file))
+
+@lru_cache(maxsize=None)
+def get_cached_edge_index_arrays(dirname):
+    return load_edge_index_arrays(dirname)
+
 def load_total_sub_edges(filename):
     total_sub_edges = {}
     
@@ -197,6 +959,78 @@ def load_total_edges():
         
     return total_edges
 
+class SubEdgeLookup:
+    """
+    Memory-mapped view of a sub_edges bundle (see graph.save_sub_edges_bundle).
+    Whole trips are mapped with one vectorized binary search.
+    """
+    def __init__(self, dirname, mmap_mode='r'):
+        with open(os.path.join(dirname, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('format') != 'sub_edges' or manifest.get('version') != SUB_EDGES_FORMAT_VERSION:
+            raise ValueError(f"Unsupported sub_edges bundle in {dirname}: {manifest}")
+        
+        self.nodes = np.load(os.path.join(dirname, 'nodes.npy'), mmap_mode=mmap_mode)
+        self.pair_keys = np.load(os.path.join(dirname, 'pair_keys.npy'), mmap_mode=mmap_mode)
+        self.way_index = np.load(os.path.join(dirname, 'way_index.npy'), mmap_mode=mmap_mode)
+        self.ways = np.load(os.path.join(dirname, 'ways.npy'), mmap_mode=mmap_mode)
+        self.way_offsets = np.load(os.path.join(dirname, 'way_offsets.npy'), mmap_mode=mmap_mode)
+        self.way_nodes = np.load(os.path.join(dirname, 'way_nodes.npy'), mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return len(self.pair_keys)
+
+    def lookup(self, sub_edges):
+        # Position in `ways` of every sub-edge, -1 if it is not on a highway way
+        pairs = np.asarray(sub_edges, dtype=np.int64).reshape(-1, 2)
+        if len(self.pair_keys) == 0:
+            return np.full(len(pairs), -1, dtype=np.int64)
+        
+        n = len(self.nodes)
+        rank_u = np.minimum(np.searchsorted(self.nodes, pairs[:, 0]), n - 1)
+        rank_v = np.minimum(np.searchsorted(self.nodes, pairs[:, 1]), n - 1)
+        found = (self.nodes[rank_u] == pairs[:, 0]) & (self.nodes[rank_v] == pairs[:, 1])
+        
+        keys = rank_u * n + rank_v
+        pos = np.minimum(np.searchsorted(self.pair_keys, keys), len(self.pair_keys) - 1)
+        found &= self.pair_keys[pos] == keys
+        
+        return np.where(found, self.way_index[pos], -1).astype(np.int64)
+
+    def lookup_ways(self, sub_edges):
+        # OSM way id of every sub-edge, -1 if not found
+        positions = self.lookup(sub_edges)
+        return np.where(positions >= 0, self.ways[np.maximum(positions, 0)], -1)
+
+    def edge_indices(self, sub_edges):
+        # Matrix index (as in get_edge_index, which numbers ways from 1), 0 if not found
+        return (self.lookup(sub_edges) + 1).astype(np.int32)
+
+    def check_edge_index(self, edge_index):
+        # edge_indices() is bundle position + 1, so the ways must be listed in edge_index order
+        if not isinstance(edge_index, EdgeIndexArrays):
+            edge_index = EdgeIndexArrays.from_edge_index(edge_index)
+        if not np.array_equal(edge_index.index_to_way[1:], self.ways):
+            raise ValueError(f"sub_edges bundle ({len(self.ways)} ways) does not list the ways of "
+                             f"edge_index ({len(edge_index)} edges) in index order")
+
+    def get_sub_edges(self, positions):
+        # (node_u, node_v) of the stored sub-edges at the given positions
+        keys = self.pair_keys[positions]
+        return np.stack([self.nodes[keys // len(self.nodes)], self.nodes[keys % len(self.nodes)]], axis=-1)
+
+    def get_way_nodes(self, position):
+        return self.way_nodes[self.way_offsets[position]:self.way_offsets[position + 1]]
+
+    def get_total_edges(self):
+        # Same shape as the JSON total_edges: str way id -> node list
+        return {str(way): self.get_way_nodes(i).tolist() for i, way in enumerate(self.ways)}
+
+def load_sub_edges_bundle(dirname):
+    sub_edge_lookup = SubEdgeLookup(dirname)
+    print("Load sub_edges bundle successfully")
+    return sub_edge_lookup
+
 def get_rows_from_matrix(edge_list, edge_matrix, edge_index):
     rows = defaultdict(dict)
     for edge in edge_list:
@@ -212,9 +1046,13 @@ def get_rows_from_matrix(edge_list, edge_matrix, edge_index):
     # total_sub_edges = load_total_sub_edges(total_sub_edges_file)
     # total_edges = load_total_edges()
     
-    # Save edge_index
+    # Convert the JSON total_edges into the binary sub_edges bundle (once)
+    # save_sub_edges_bundle(total_edges, sub_edges_dir)
+    
+    # Save edge_index (pickle + array form in output/edge_index/)
     # edge_index = get_edge_index(total_edges)
     # save_edge_index(index_file, edge_index)
+    # edge_index = open_edge_index(index_file)  # memory-mapped, decodes whole columns
     
     # Load raw data and save to matrix (sparse)
     # edge_index = load_edge_index(index_file)
@@ -226,6 +1064,22 @@ def get_rows_from_matrix(edge_list, edge_matrix, edge_index):
     # print(f"Processing time: {time2-time1}s")
     # save_inter_edges_matrix(inter_edges_freq, matrix_size, edge_index)
     
+    # Vectorized engine (same matrix as above)
+    # check_matrix_parity(json_file, total_sub_edges, edge_index)
+    # sparse_matrix = build_inter_edges_matrix(json_file, total_sub_edges, edge_index)
+    # sparse_matrix = build_inter_edges_matrix_parallel(json_file, total_sub_edges, edge_index)
+    # sparse_matrix = build_inter_edges_matrix_parallel(json_file, sub_edges_dir, edge_index)
+    # save_top_k(top_k_file, build_top_k_inter_edges(json_file, sub_edges_dir, edge_index, k=5))
+    # sparse_matrix = build_inter_edges_matrix_streaming(json_file, total_sub_edges, edge_index, memory_budget=256 * 1024 * 1024)
+    
+    # Larger / unbounded window, long trips capped at 200k triples each
+    # sparse_matrix = build_inter_edges_matrix_parallel(json_file, sub_edges_dir, edge_index, windows=50)
+    # sparse_matrix = build_inter_edges_matrix_parallel(json_file, sub_edges_dir, edge_index, windows=None, max_triples=200000)
+    
+    # Keep revisits of an edge (loops), only runs on the same edge are collapsed
+    # sparse_matrix = build_inter_edges_matrix_parallel(json_file, sub_edges_dir, edge_index, dedupe='consecutive')
+    # sparse.save_npz(matrix_file, sparse_matrix)
+    
 # Result of saving matrix
 # Load total_sub_edges successfully
 # Load total_edges successfully
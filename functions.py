@@ -4,6 +4,8 @@ import pickle
 from collections import defaultdict
 from scipy import sparse
 from tqdm import tqdm
+from edge_matrix import EdgeIndexArrays, SubEdgeLookup, get_sub_edge_index, iter_encoded_chunks, iter_trips
+from metrics import metrics
 
 
 """  
@@ -16,6 +18,10 @@ of adjacent edges to test and debug.
 This module is not used for handling task 3.2, 3.3. 
 For those tasks, they are on edge_matrix.py.This module 
 is used to debug and testing some functions.
+
+The way-level transition matrix at the bottom is the production
+version: it counts way -> next way over the same edge_index as
+inter_edges_matrix and is shipped in the artifact bundle.
 """
 
 json_file = 'jsonFiles/bus_history.json'
@@ -58,23 +64,20 @@ def get_total_edges(json_file):
         for line in f:
             data.append(json.loads(line.strip()))
     
+    seen = set()
     for vehicle in data:
         for trip in vehicle['tripList']:
             edges = trip['edgesOfPath2']
             for edge in edges:
-                if edge not in total_edges:
+                if tuple(edge) not in seen:
+                    seen.add(tuple(edge))
                     total_edges.append(edge)
     
     return total_edges
 
 def get_edge_from_index(edge_index):
-    total_edges = get_total_edges(json_file)
-    index_to_edge = {}
-    for edge in total_edges:
-        index = edge_index.get(tuple(edge), None)
-        index_to_edge[index] = edge
-        
-    return index_to_edge
+    # edge_index already holds every edge of the history, so invert it instead of re-reading the file
+    return {index: list(edge) for edge, index in edge_index.items()}
 
 def create_edge_matrix(edge_transitions, edge_index):
     matrix_size = len(edge_index)
@@ -167,14 +170,101 @@ def print_rows_from_edge(edge_list, edge_matrix, edge_index):
         for col_idx, value in col_vals.items():
             print(f"    Column {col_idx} with Value: {value}")
         print()  
-        
 
+# Way-level transitions: transition_matrix[i, j] = number of times way j directly
+# follows way i in a trip, on the same edge_index as inter_edges_matrix (index 0 unused)
+transition_matrix_file = 'output/transition_matrix.npz'
 
-    
+def get_transition_keys(edges, edge_size):
+    # Packed (from, to) key of every consecutive pair of ways
+    edges = np.asarray(edges, dtype=np.int64)
+    return edges[:-1] * (edge_size + 1) + edges[1:]
+
+def count_transition_keys(keys, edge_size):
+    # Dense bincount while the N*N table is small, sort-based unique otherwise
+    size = edge_size + 1
+    if size * size <= 1 << 24:
+        counts = np.bincount(keys, minlength=size * size)
+        keys = np.flatnonzero(counts)
+        return keys, counts[keys]
+    return np.unique(keys, return_counts=True)
+
+def merge_transition_counts(parts):
+    keys = np.concatenate([part[0] for part in parts]) if parts else np.empty(0, dtype=np.int64)
+    counts = np.concatenate([part[1] for part in parts]) if parts else np.empty(0, dtype=np.int64)
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse.ravel(), weights=counts, minlength=len(keys)).astype(np.int64)
+
+def build_transition_matrix(json_file, total_sub_edges, edge_index, chunk_size=1000):
+    """
+    First-order way transition counts of the whole history. Trips are
+    mapped with dedupe='consecutive', so sub-edges on the same way collapse
+    into one step and a way never transitions to itself; unmapped sub-edges
+    are dropped, joining the ways around them. `total_sub_edges` is the
+    sub-edge dict or a sub_edges bundle directory.
+    """
+    edge_size = len(edge_index)
+    size = edge_size + 1
+    if isinstance(total_sub_edges, str):
+        sub_edge_index = SubEdgeLookup(total_sub_edges)
+        sub_edge_index.check_edge_index(edge_index)
+    else:
+        sub_edge_index = get_sub_edge_index(total_sub_edges, edge_index)
+
+    parts = []
+    with metrics.stage('count_transitions'):
+        for chunk in iter_encoded_chunks(iter_trips(json_file), sub_edge_index, chunk_size, 'consecutive'):
+            keys = np.concatenate([get_transition_keys(edges, edge_size) for edges in chunk])
+            metrics.count('transitions', len(keys))
+            parts.append(count_transition_keys(keys, edge_size))
+        keys, counts = merge_transition_counts(parts)
 
+    return sparse.csr_matrix((counts.astype(np.int32), (keys // size, keys % size)), shape=(size, size))
 
+def save_transition_matrix(transition_matrix, transition_matrix_file=transition_matrix_file):
+    sparse.save_npz(transition_matrix_file, transition_matrix)
+    print("Save transition_matrix successfully")
 
+def load_transition_matrix(transition_matrix_file=transition_matrix_file):
+    transition_matrix = sparse.load_npz(transition_matrix_file)
+    print("Load transition_matrix successfully")
+    return transition_matrix
 
+def normalize_transition_matrix(transition_matrix):
+    # Row-stochastic copy: P[i, j] = count(i -> j) / count(i -> any), rows without transitions stay 0
+    totals = np.asarray(transition_matrix.sum(axis=1), dtype=np.float64).ravel()
+    scale = np.divide(1.0, totals, out=np.zeros_like(totals), where=totals > 0)
+    return sparse.csr_matrix(transition_matrix.multiply(scale[:, None]))
 
+def get_transition_probabilities(transition_matrix, from_edges, to_edges, edge_index):
+    # P(next way = to_edges[n] | way = from_edges[n]) for way ids, 0 for unknown ways / no transitions
+    if not isinstance(edge_index, EdgeIndexArrays):
+        edge_index = EdgeIndexArrays.from_edge_index(edge_index)
+    rows = edge_index.to_indices(np.asarray(from_edges, dtype=np.int64).ravel())
+    cols = edge_index.to_indices(np.asarray(to_edges, dtype=np.int64).ravel())
+    counts = np.asarray(transition_matrix[rows, cols], dtype=np.float64).ravel()
+    totals = np.asarray(transition_matrix[rows].sum(axis=1), dtype=np.float64).ravel()
+    return np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
 
+def get_next_edges(transition_matrix, edge, edge_index, n=5):
+    # Top-n ways that follow `edge`: [(way_id, count, probability)], most frequent first
+    if not isinstance(edge_index, EdgeIndexArrays):
+        edge_index = EdgeIndexArrays.from_edge_index(edge_index)
+    index = int(edge_index.to_indices(int(edge)))
+    if index == 0:
+        return []
+    start, end = transition_matrix.indptr[index], transition_matrix.indptr[index + 1]
+    cols = np.asarray(transition_matrix.indices[start:end])
+    counts = np.asarray(transition_matrix.data[start:end])
+    order = np.lexsort((cols, -counts))[:n]
+    total = int(counts.sum())
+    return [(int(way), int(count), count / total)
+            for way, count in zip(edge_index.to_way_ids(cols[order]).tolist(), counts[order].tolist())]
 
+# Build once, package with the inter_edges_matrix, query from the bundle
+# edge_index = open_edge_index(index_file)
+# transition_matrix = build_transition_matrix(json_file, sub_edges_dir, edge_index)
+# save_matrix_artifacts(load_inter_edges_matrix(matrix_file), edge_index, sub_edges_dir,
+#                       transition_matrix=transition_matrix)
+# matrix_artifacts = load_matrix_artifacts()
+# get_next_edges(matrix_artifacts.transition_matrix, 24403452, matrix_artifacts.edge_index)
@@ -1,6 +1,11 @@
 import osmium
 import networkx as nx
+import numpy as np
 import json
+import os
+from array import array
+from itertools import chain
+from metrics import metrics
 
 """  
 [module: graph]
@@ -37,6 +42,7 @@ class OSMHandler(osmium.SimpleHandler):
             'tags': {t.k: t.v for t in r.tags}
         }
 
+@metrics.timed('osm_handler_ingest')
 def create_graph_from_osm(osm_file):
     handler = OSMHandler()
     handler.apply_file(osm_file)
@@ -63,9 +69,88 @@ def create_graph_from_osm(osm_file):
         if 'highway' in tags:
             G.add_edge(nodes[0], nodes[len(nodes) - 1], wayid=way_id, **tags)
             total_edges[way_id] = nodes
-                
+    
+    metrics.count('osm_nodes', len(handler.nodes))
+    metrics.count('highway_ways', len(total_edges))
     return G, total_edges
 
+# Lean ingest: only highway ways are kept, with their node list in one flat
+# int64 buffer and node coordinates taken from the osmium location index,
+# so no per-node / per-way dict is ever created.
+class LeanOSMHandler(osmium.SimpleHandler):
+    def __init__(self):
+        super(LeanOSMHandler, self).__init__()
+        self.way_ids = array('q')
+        self.way_lengths = array('q')
+        self.way_nodes = array('q')
+        self.lats = array('d')
+        self.lons = array('d')
+
+    def way(self, w):
+        if 'highway' not in w.tags:
+            return
+        self.way_ids.append(w.id)
+        self.way_lengths.append(len(w.nodes))
+        for n in w.nodes:
+            self.way_nodes.append(n.ref)
+            self.lats.append(n.lat if n.location.valid() else np.nan)
+            self.lons.append(n.lon if n.location.valid() else np.nan)
+
+class OSMArrays:
+    """
+    Highway network of an OSM file as NumPy arrays:
+    nodes (sorted int64 ids) with lat / lon, and ways whose node lists are
+    way_nodes[way_offsets[i]:way_offsets[i + 1]].
+    """
+    def __init__(self, nodes, lat, lon, ways, way_offsets, way_nodes):
+        self.nodes = nodes
+        self.lat = lat
+        self.lon = lon
+        self.ways = ways
+        self.way_offsets = way_offsets
+        self.way_nodes = way_nodes
+
+    def get_way_nodes(self, position):
+        return self.way_nodes[self.way_offsets[position]:self.way_offsets[position + 1]]
+
+    def get_total_edges(self):
+        # Same shape as create_graph_from_osm's total_edges: way id -> node list
+        return {int(way): self.get_way_nodes(i).tolist() for i, way in enumerate(self.ways)}
+
+@metrics.timed('osm_lean_ingest')
+def load_osm_arrays(osm_file):
+    handler = LeanOSMHandler()
+    handler.apply_file(osm_file, locations=True)
+
+    way_nodes = np.frombuffer(handler.way_nodes, dtype=np.int64)
+    way_offsets = np.zeros(len(handler.way_lengths) + 1, dtype=np.int64)
+    np.cumsum(np.frombuffer(handler.way_lengths, dtype=np.int64), out=way_offsets[1:])
+
+    nodes, first = np.unique(way_nodes, return_index=True)
+    lat = np.frombuffer(handler.lats, dtype=np.float64)[first]
+    lon = np.frombuffer(handler.lons, dtype=np.float64)[first]
+    metrics.count('osm_nodes', len(nodes))
+    metrics.count('highway_ways', len(handler.way_ids))
+
+    return OSMArrays(nodes, lat, lon, np.frombuffer(handler.way_ids, dtype=np.int64).copy(),
+                     way_offsets, way_nodes.copy())
+
+def create_graph_from_arrays(osm_arrays):
+    # Same edges as create_graph_from_osm (first -> last node of each highway way), tags excluded
+    G = nx.MultiDiGraph()
+    for node_id, lat, lon in zip(osm_arrays.nodes.tolist(), osm_arrays.lat.tolist(), osm_arrays.lon.tolist()):
+        G.add_node(node_id, lat=lat, lon=lon)
+    for i, way_id in enumerate(osm_arrays.ways.tolist()):
+        nodes = osm_arrays.get_way_nodes(i)
+        G.add_edge(int(nodes[0]), int(nodes[-1]), wayid=way_id)
+    return G
+
+def create_lean_graph_from_osm(osm_file, graph=False):
+    # networkx is only built when explicitly requested
+    osm_arrays = load_osm_arrays(osm_file)
+    G = create_graph_from_arrays(osm_arrays) if graph else None
+    return G, osm_arrays
+
 def save_total_edges(total_edges):
     with open("output/total_edges", 'w') as f:
         json.dump(total_edges, f)
@@ -89,8 +174,68 @@ def save_total_sub_edges(total_sub_edges, filename):
     
     print("Save total_sub_edges successfully")
     
+# Binary sub-edge bundle: replaces the JSON total_edges / total_sub_edges files.
+# Node ids are stored once (sorted), sub-edges as sorted int64 pair keys
+# (rank_u * n_nodes + rank_v) with the position of their way in `ways`.
+SUB_EDGES_FORMAT_VERSION = 1
+
+def save_sub_edges_bundle(total_edges, dirname):
+    if isinstance(total_edges, OSMArrays):
+        save_sub_edges_bundle_arrays(total_edges.ways, total_edges.way_offsets, total_edges.way_nodes, dirname)
+        return
+    
+    ways = np.array([int(way_id) for way_id in total_edges], dtype=np.int64)
+    lengths = np.array([len(nodes) for nodes in total_edges.values()], dtype=np.int64)
+    way_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=way_offsets[1:])
+    way_nodes = np.fromiter(chain.from_iterable(total_edges.values()), dtype=np.int64, count=int(way_offsets[-1]))
+    save_sub_edges_bundle_arrays(ways, way_offsets, way_nodes, dirname)
+
+@metrics.timed('save_sub_edges_bundle')
+def save_sub_edges_bundle_arrays(ways, way_offsets, way_nodes, dirname):
+    os.makedirs(dirname, exist_ok=True)
+    lengths = np.diff(way_offsets)
+    
+    # Consecutive node pairs of every way, both directions, in the order
+    # convert_sub_edges_to_edge writes them (a later way overwrites an earlier one)
+    is_last = np.zeros(len(way_nodes), dtype=bool)
+    is_last[way_offsets[1:][lengths > 0] - 1] = True
+    starts = np.flatnonzero(~is_last)
+    node_u = np.stack([way_nodes[starts], way_nodes[starts + 1]], axis=1).ravel()
+    node_v = np.stack([way_nodes[starts + 1], way_nodes[starts]], axis=1).ravel()
+    way_index = np.repeat(np.arange(len(ways), dtype=np.int32), 2 * np.maximum(lengths - 1, 0))
+    
+    nodes = np.unique(way_nodes)
+    pair_keys = np.searchsorted(nodes, node_u) * len(nodes) + np.searchsorted(nodes, node_v)
+    _, last = np.unique(pair_keys[::-1], return_index=True)
+    last = len(pair_keys) - 1 - last
+    
+    np.save(os.path.join(dirname, 'nodes.npy'), nodes)
+    np.save(os.path.join(dirname, 'pair_keys.npy'), pair_keys[last])
+    np.save(os.path.join(dirname, 'way_index.npy'), way_index[last])
+    np.save(os.path.join(dirname, 'ways.npy'), ways)
+    np.save(os.path.join(dirname, 'way_offsets.npy'), way_offsets)
+    np.save(os.path.join(dirname, 'way_nodes.npy'), way_nodes)
+    
+    manifest = {
+        'format': 'sub_edges',
+        'version': SUB_EDGES_FORMAT_VERSION,
+        'nodes': len(nodes),
+        'sub_edges': len(last),
+        'ways': len(ways),
+    }
+    with open(os.path.join(dirname, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    
+    print("Save sub_edges bundle successfully")
+
 # Load graph + Save total edges + Save total sub edges
 # G, total_edges = create_graph_from_osm(osm_file="osmFiles/HoChiMinh.osm")
 # total_sub_edges = convert_sub_edges_to_edge(total_edges)
 # save_total_sub_edges(total_sub_edges, filename="output/total_sub_edges")
-# save_total_edges(total_edges)
\ No newline at end of file
+# save_total_edges(total_edges)
+# save_sub_edges_bundle(total_edges, dirname="output/sub_edges")
+
+# Lean path: highway arrays only, no networkx
+# G, osm_arrays = create_lean_graph_from_osm(osm_file="osmFiles/HoChiMinh.osm")
+# save_sub_edges_bundle(osm_arrays, dirname="output/sub_edges")
@@ -0,0 +1,250 @@
+import json
+import os
+import time
+import numpy as np
+from edge_matrix import *
+
+
+"""
+[module: incremental_update]
+
+This module is used to fold new bus_history batches into a persisted
+count store ((edge_i, edge_j, intermediate) -> count) instead of
+rebuilding the inter_edges_matrix from scratch. Only the pairs touched
+by a batch are recomputed, and the .npz files are replaced atomically.
+"""
+
+count_store_dir = 'output/count_store'
+COUNT_STORE_VERSION = 1
+
+class CountStore:
+    def __init__(self, store_dir=count_store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('version') != COUNT_STORE_VERSION:
+            raise ValueError(f"Unsupported count store in {store_dir}: {self.manifest}")
+
+        self.edge_size = self.manifest['edge_size']
+        self.windows = self.manifest['windows']
+        self.max_triples = self.manifest.get('max_triples')
+        self.dedupe = self.manifest.get('dedupe', 'global')
+        self.keys = np.load(os.path.join(store_dir, 'keys.npy'))
+        self.counts = np.load(os.path.join(store_dir, 'counts.npy'))
+        self.first = np.load(os.path.join(store_dir, 'first.npy'))
+
+    @classmethod
+    def create(cls, store_dir, edge_size, windows=10, max_triples=None, dedupe='global'):
+        os.makedirs(store_dir, exist_ok=True)
+        store = cls.__new__(cls)
+        store.store_dir = store_dir
+        store.manifest = {'version': COUNT_STORE_VERSION, 'edge_size': edge_size, 'windows': windows,
+                          'max_triples': max_triples, 'dedupe': dedupe, 'next_order': 0, 'batches': []}
+        store.edge_size = edge_size
+        store.windows = windows
+        store.max_triples = max_triples
+        store.dedupe = dedupe
+        store.keys = np.empty(0, dtype=np.int64)
+        store.counts = np.empty(0, dtype=np.float64)
+        store.first = np.empty(0, dtype=np.int64)
+        return store
+
+    def fold(self, keys, counts, first, decay=1.0, min_weight=0.0):
+        """
+        Add a batch of sorted, unique counts. Old weights are multiplied by
+        `decay` first; entries below `min_weight` are dropped.
+        Returns the sorted pair keys whose argmax / top-K must be recomputed.
+        """
+        size = self.edge_size + 1
+        affected = [np.unique(keys // size)]
+
+        if decay != 1.0:
+            self.counts *= decay
+        if min_weight > 0:
+            # Uniform decay keeps every argmax, unless a pair loses all of its entries
+            dropped = self.counts < min_weight
+            if dropped.any():
+                affected.append(np.unique(self.keys[dropped] // size))
+                self.keys = self.keys[~dropped]
+                self.counts = self.counts[~dropped]
+                self.first = self.first[~dropped]
+
+        # Batch order comes after everything already stored (tie-break = first seen)
+        first = first + self.manifest['next_order']
+        if len(first):
+            self.manifest['next_order'] = int(first.max()) + 1
+
+        pos = np.searchsorted(self.keys, keys)
+        exists = pos < len(self.keys)
+        exists[exists] = self.keys[pos[exists]] == keys[exists]
+        np.add.at(self.counts, pos[exists], counts[exists])
+
+        new = ~exists
+        self.keys = np.insert(self.keys, pos[new], keys[new])
+        self.counts = np.insert(self.counts, pos[new], counts[new].astype(np.float64))
+        self.first = np.insert(self.first, pos[new], first[new])
+
+        return np.unique(np.concatenate(affected))
+
+    def select_pairs(self, pair_keys):
+        # Every stored (key, count, first) of the given pairs
+        size = self.edge_size + 1
+        lo = np.searchsorted(self.keys, pair_keys * size)
+        hi = np.searchsorted(self.keys, (pair_keys + 1) * size)
+        lengths = hi - lo
+        slots = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self.keys[slots], self.counts[slots], self.first[slots]
+
+    def save(self):
+        for name in ('keys', 'counts', 'first'):
+            tmp_file = os.path.join(self.store_dir, f"{name}.tmp.npy")
+            np.save(tmp_file, getattr(self, name))
+            os.replace(tmp_file, os.path.join(self.store_dir, f"{name}.npy"))
+
+        tmp_file = os.path.join(self.store_dir, 'manifest.tmp.json')
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_file, os.path.join(self.store_dir, 'manifest.json'))
+        print("Save count_store successfully")
+
+def merge_partial_counts(partial_counts, edge_size):
+    # All runs of a batch as one sorted, unique (keys, counts, first)
+    blocks = list(merge_count_runs(partial_counts.load_runs(), edge_size))
+    if not blocks:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    return tuple(np.concatenate(column) for column in zip(*blocks))
+
+def update_inter_edges_matrix(inter_edges_matrix, affected, rows, cols, inters, edge_size):
+    # Drop the affected pairs' old entries and add the recomputed ones
+    size = edge_size + 1
+    if inter_edges_matrix is None:
+        inter_edges_matrix = sparse.csr_matrix((size, size), dtype=np.int32)
+
+    old = inter_edges_matrix.tocoo()
+    keep = ~np.isin(old.row.astype(np.int64) * size + old.col, affected)
+    rows = np.concatenate([old.row[keep], rows])
+    cols = np.concatenate([old.col[keep], cols])
+    inters = np.concatenate([old.data[keep], inters]).astype(np.int32)
+
+    return sparse.csr_matrix((inters, (rows, cols)), shape=(size, size))
+
+def update_top_k(top_k, affected, new_top_k):
+    # Splice the recomputed pairs into the ragged top-K layout, keeping pairs sorted
+    if top_k is None:
+        return new_top_k
+
+    keep_pairs = ~np.isin(top_k['pair_keys'], affected)
+    lengths = np.diff(top_k['offsets'])
+    keep_entries = np.repeat(keep_pairs, lengths)
+
+    pair_keys = np.concatenate([top_k['pair_keys'][keep_pairs], new_top_k['pair_keys']])
+    lengths = np.concatenate([lengths[keep_pairs], np.diff(new_top_k['offsets'])])
+    order = np.argsort(pair_keys, kind='stable')
+
+    # Entry slots of every pair in the concatenated arrays, gathered in pair order
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    slots = np.repeat(starts[order] - np.cumsum(lengths[order]) + lengths[order], lengths[order])
+    slots += np.arange(len(slots))
+
+    offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(lengths[order], out=offsets[1:])
+
+    top_k = dict(top_k)
+    top_k['pair_keys'] = pair_keys[order]
+    top_k['offsets'] = offsets
+    for name in ('inters', 'counts'):
+        top_k[name] = np.concatenate([top_k[name][keep_entries], new_top_k[name]])[slots]
+    top_k['totals'] = np.concatenate([top_k['totals'][keep_pairs], new_top_k['totals']])[order]
+    return top_k
+
+def save_npz_atomic(filename, save):
+    # Write next to the target and rename, so readers never see a partial file
+    tmp_file = f"{filename[:-len('.npz')]}.tmp.npz"
+    save(tmp_file)
+    os.replace(tmp_file, filename)
+
+def ingest_batch(json_file, total_sub_edges, edge_index, store_dir=count_store_dir, matrix_file=matrix_file,
+                 top_k_file=None, k=5, decay=1.0, min_weight=0.0, windows=10, processes=None,
+                 max_triples=None, dedupe='global', overwrite=False):
+    """
+    Fold one JSON-lines batch into the count store and update the matrix
+    (and the top-K file if given) for the affected pairs only. With decay
+    every stored weight shrinks, so the whole top-K is re-ranked from the
+    store (the matrix argmax does not change under a uniform decay).
+    A new store writes fresh matrix / top-K files; it only replaces
+    existing ones with overwrite=True (see seed_count_store).
+    """
+    edge_size = len(edge_index)
+    time1 = time.time()
+
+    new_store = not os.path.exists(os.path.join(store_dir, 'manifest.json'))
+    if new_store:
+        existing = [filename for filename in (matrix_file, top_k_file)
+                    if filename is not None and os.path.exists(filename)]
+        if existing and not overwrite:
+            raise FileExistsError(f"New count store in {store_dir} would replace {existing} with this batch only; "
+                                  f"seed it from the full history with seed_count_store, or pass other files")
+        store = CountStore.create(store_dir, edge_size, windows, max_triples, dedupe)
+        store.manifest['matrix_file'] = matrix_file
+        store.manifest['top_k_file'] = top_k_file
+    else:
+        store = CountStore(store_dir)
+        settings = (store.edge_size, store.windows, store.max_triples, store.dedupe)
+        if settings != (edge_size, windows, max_triples, dedupe):
+            raise ValueError(f"Count store in {store_dir} was built with edge_size={store.edge_size}, "
+                             f"windows={store.windows}, max_triples={store.max_triples}, dedupe={store.dedupe}")
+        # The matrix / top-K files must be the ones this store has been writing
+        for name, filename in (('matrix_file', matrix_file), ('top_k_file', top_k_file)):
+            if store.manifest.get(name, filename) != filename:
+                raise ValueError(f"Count store in {store_dir} maintains {name}={store.manifest[name]}, not {filename}")
+
+    partial_counts = count_inter_edges_parallel(json_file, total_sub_edges, edge_index, windows,
+                                                processes=processes, max_triples=max_triples, dedupe=dedupe)
+    try:
+        keys, counts, first = merge_partial_counts(partial_counts, edge_size)
+    finally:
+        partial_counts.cleanup()
+
+    affected = store.fold(keys, counts, first, decay, min_weight)
+    affected_counts = store.select_pairs(affected)
+
+    # A new store holds only this batch, so existing files (e.g. a full build) are not spliced into
+    inter_edges_matrix = None if new_store or not os.path.exists(matrix_file) else load_inter_edges_matrix(matrix_file)
+    rows, cols, inters = select_most_frequent(*affected_counts, edge_size)
+    inter_edges_matrix = update_inter_edges_matrix(inter_edges_matrix, affected, rows, cols, inters, edge_size)
+    save_npz_atomic(matrix_file, lambda tmp_file: sparse.save_npz(tmp_file, inter_edges_matrix))
+
+    if top_k_file is not None:
+        top_k = None if new_store or not os.path.exists(top_k_file) else load_top_k(top_k_file)
+        k = k if top_k is None else int(top_k['k'])
+        if decay != 1.0:
+            # Unaffected pairs are decayed too, their counts and totals come from the store again
+            top_k = finish_top_k([select_top_k(store.keys, store.counts, store.first, edge_size, k)], edge_size, k)
+        else:
+            new_top_k = finish_top_k([select_top_k(*affected_counts, edge_size, k)], edge_size, k)
+            top_k = update_top_k(top_k, affected, new_top_k)
+        save_npz_atomic(top_k_file, lambda tmp_file: np.savez(tmp_file, **top_k))
+
+    store.manifest['batches'].append({'file': json_file, 'ingested_at': time.time(), 'decay': decay})
+    store.save()
+
+    time2 = time.time()
+    print(f"Ingested {json_file}: {len(affected)} pairs updated in {time2-time1}s")
+    return inter_edges_matrix
+
+def seed_count_store(json_file, total_sub_edges, edge_index, store_dir=count_store_dir, matrix_file=matrix_file,
+                     top_k_file=None, k=5, windows=10, processes=None, max_triples=None, dedupe='global'):
+    # Build a new store from the full history; its matrix / top-K replace the files given
+    if os.path.exists(os.path.join(store_dir, 'manifest.json')):
+        raise FileExistsError(f"Count store in {store_dir} already exists")
+    return ingest_batch(json_file, total_sub_edges, edge_index, store_dir, matrix_file, top_k_file, k,
+                        windows=windows, processes=processes, max_triples=max_triples, dedupe=dedupe, overwrite=True)
+
+# Seed the store once from the full history (rebuilds matrix_file / top_k_file from it),
+# then fold every new day into it
+# edge_index = load_edge_index(index_file)
+# seed_count_store(json_file, sub_edges_dir, edge_index, top_k_file=top_k_file)
+# ingest_batch('jsonFiles/bus_history_day2.json', sub_edges_dir, edge_index, top_k_file=top_k_file,
+#              decay=0.95, min_weight=0.5)
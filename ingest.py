@@ -0,0 +1,169 @@
+import glob
+import gzip
+import os
+from edge_matrix import *
+
+
+"""
+[module: ingest]
+
+This module is used to count a whole bus_history archive (many daily
+JSON-lines files, some gzip-compressed) into the inter_edges_matrix.
+The input is a file, a directory or a glob. Plain files are cut into
+byte ranges that end on line boundaries; workers read their own range
+from disk, so only (file, start, end) goes through the pool. A .gz file
+cannot be seeked into, so the parent decompresses it as a stream and
+sends its lines in chunks of about the same size. Every chunk feeds
+the same partial counts as build_inter_edges_matrix_parallel, and
+chunks are numbered in file order, so the matrix (ties included) is
+the one of the concatenated history.
+"""
+
+HISTORY_SUFFIXES = ('.json', '.jsonl', '.json.gz', '.jsonl.gz')
+
+def resolve_history_files(source):
+    # Sorted list of history files from a path, a directory, a glob or a list of those
+    if isinstance(source, (list, tuple)):
+        return sorted({filename for item in source for filename in resolve_history_files(item)})
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if name.endswith(HISTORY_SUFFIXES) and os.path.isfile(os.path.join(source, name)))
+    if os.path.isfile(source):
+        return [source]
+    files = sorted(filename for filename in glob.glob(source) if os.path.isfile(filename))
+    if not files:
+        raise FileNotFoundError(f"No bus_history files match {source}")
+    return files
+
+def is_gzip_file(filename):
+    return filename.endswith('.gz')
+
+def get_byte_ranges(filename, chunk_bytes=8 * 1024 * 1024):
+    """
+    (start, end) ranges of about chunk_bytes that never split a line (plain files).
+    A range boundary is moved forward to the byte after the next newline.
+    """
+    size = os.path.getsize(filename)
+    if size <= chunk_bytes:
+        return [(0, size)]
+
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        for target in range(chunk_bytes, size, chunk_bytes):
+            if target <= bounds[-1]:
+                continue
+            # Reading from target - 1 keeps a boundary that already sits at a line start
+            f.seek(target - 1)
+            f.readline()
+            bound = f.tell()
+            if bound >= size:
+                break
+            bounds.append(bound)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def read_range_lines(filename, start, end):
+    # Non-empty raw lines (bytes) of one range of a plain file
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return [line for line in data.split(b'\n') if line.strip()]
+
+def iter_gzip_line_chunks(filename, chunk_bytes=8 * 1024 * 1024):
+    # Decompressed lines of a .gz file in chunks of about chunk_bytes, with the compressed bytes each one took
+    size = os.path.getsize(filename)
+    consumed = 0
+    with gzip.open(filename, 'rb') as f:
+        chunk, chunk_size = [], 0
+        for line in f:
+            if line.strip():
+                chunk.append(line)
+                chunk_size += len(line)
+            if chunk_size >= chunk_bytes:
+                position = min(f.fileobj.tell(), size)
+                yield chunk, position - consumed
+                consumed = position
+                chunk, chunk_size = [], 0
+    if chunk or consumed < size:
+        yield chunk, size - consumed
+
+def iter_history_chunks(files, chunk_bytes=8 * 1024 * 1024):
+    """
+    (task function, task arguments, disk bytes) in file order; the position
+    in this sequence is the chunk id. Plain files become byte ranges read by
+    the worker, .gz files are streamed here into line chunks.
+    """
+    for filename in files:
+        if is_gzip_file(filename):
+            for lines, disk_bytes in iter_gzip_line_chunks(filename, chunk_bytes):
+                yield process_trip_chunk, (lines,), disk_bytes
+        else:
+            for start, end in get_byte_ranges(filename, chunk_bytes):
+                yield process_byte_range, (filename, start, end), end - start
+
+def iter_history_trips(source):
+    # Serial reader over the same files, for callers that want trips one by one
+    for filename in resolve_history_files(source):
+        with (gzip.open if is_gzip_file(filename) else open)(filename, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    for trip in json_loads(line)['tripList']:
+                        yield trip
+
+def process_byte_range(chunk_id, filename, start, end):
+    return process_trip_chunk(chunk_id, read_range_lines(filename, start, end))
+
+def collect_byte_range(result, partial_counts, progress, disk_bytes):
+    # Progress is in bytes on disk (compressed for .gz), so the bar ends at the archive size
+    trips = collect_trip_chunk(result, partial_counts)
+    progress.update(disk_bytes)
+    return trips
+
+def count_inter_edges_files(source, total_sub_edges, edge_index, windows=10, chunk_bytes=8 * 1024 * 1024,
+                            processes=None, memory_budget=512 * 1024 * 1024, spill_dir=None,
+                            max_triples=None, dedupe='global'):
+    # Same contract as count_inter_edges_parallel: the caller merges and cleans up the PartialCounts
+    files = resolve_history_files(source)
+    edge_size = len(edge_index)
+    if isinstance(total_sub_edges, str):
+        SubEdgeLookup(total_sub_edges).check_edge_index(edge_index)
+        sub_edge_index = total_sub_edges
+    else:
+        sub_edge_index = get_sub_edge_index(total_sub_edges, edge_index)
+    partial_counts = PartialCounts(memory_budget, spill_dir)
+
+    try:
+        trip_count = 0
+        processes = processes or cpu_count()
+        metrics.count('history_files', len(files))
+        with metrics.stage('count_triples_files'), \
+                tqdm(total=sum(os.path.getsize(filename) for filename in files), unit='B', unit_scale=True,
+                     desc='count_triples_files') as progress, \
+                Pool(processes, initializer=init_worker,
+                     initargs=(sub_edge_index, edge_size, windows, max_triples, dedupe)) as pool:
+            pending = []
+            collect = lambda result, disk_bytes: collect_byte_range(result, partial_counts, progress, disk_bytes)
+            for chunk_id, (task, args, disk_bytes) in enumerate(iter_history_chunks(files, chunk_bytes)):
+                pending.append((pool.apply_async(task, (chunk_id,) + args), disk_bytes))
+                trip_count += collect_ready(pending, collect, 2 * processes - 1)
+            trip_count += collect_ready(pending, collect)
+        print(f"Processed {trip_count} trips from {len(files)} files")
+    except BaseException:
+        partial_counts.cleanup()
+        raise
+
+    return partial_counts
+
+def build_inter_edges_matrix_files(source, total_sub_edges, edge_index, windows=10, chunk_bytes=8 * 1024 * 1024,
+                                   processes=None, memory_budget=512 * 1024 * 1024, spill_dir=None,
+                                   max_triples=None, dedupe='global'):
+    partial_counts = count_inter_edges_files(source, total_sub_edges, edge_index, windows, chunk_bytes, processes,
+                                             memory_budget, spill_dir, max_triples, dedupe)
+    try:
+        return create_inter_edges_matrix_from_runs(partial_counts.load_runs(), len(edge_index))
+    finally:
+        partial_counts.cleanup()
+
+# Daily archive, gzip or not, straight into the matrix
+# inter_edges_matrix = build_inter_edges_matrix_files('jsonFiles/history/*.json*', sub_edges_dir,
+#                                                     open_edge_index(index_file))
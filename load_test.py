@@ -0,0 +1,89 @@
+import asyncio
+import json
+import sys
+import time
+import numpy as np
+from edge_matrix import *
+
+
+"""
+[module: load_test]
+
+This module is used to load test server.py on localhost with
+concurrent keep-alive clients sending batches of sub-edge pairs.
+
+python load_test.py [port] [clients] [requests_per_client] [pairs_per_request]
+"""
+
+async def send_request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+
+    status = (await reader.readline()).decode()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode().partition(':')
+        headers[key.strip().lower()] = value.strip()
+    response = await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, json.loads(response)
+
+async def run_client(host, port, requests, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for pairs in requests:
+            start = time.perf_counter()
+            status, _ = await send_request(reader, writer, 'POST', '/query', {'pairs': pairs})
+            latencies.append(time.perf_counter() - start)
+            if not status.startswith('HTTP/1.1 200'):
+                raise RuntimeError(f"Request failed: {status.strip()}")
+    finally:
+        writer.close()
+
+def sample_requests(sub_edge_lookup, n_requests, pairs_per_request, seed=0):
+    rng = np.random.default_rng(seed)
+    positions = rng.integers(0, len(sub_edge_lookup), size=(n_requests, pairs_per_request, 2))
+    return sub_edge_lookup.get_sub_edges(positions).tolist()
+
+async def load_test(host, port, sub_edge_lookup, clients=16, requests_per_client=200, pairs_per_request=20):
+    requests = [sample_requests(sub_edge_lookup, requests_per_client, pairs_per_request, seed)
+                for seed in range(clients)]
+    latencies = []
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(host, port, client_requests, latencies) for client_requests in requests))
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, server_stats = await send_request(reader, writer, 'GET', '/stats')
+    writer.close()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'clients': clients,
+        'requests': len(latencies),
+        'pairs': len(latencies) * pairs_per_request,
+        'seconds': elapsed,
+        'requests_per_s': len(latencies) / elapsed,
+        'pairs_per_s': len(latencies) * pairs_per_request / elapsed,
+        'latency_ms': {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+        },
+        'server': server_stats,
+    }
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    test_port, clients, requests_per_client, pairs_per_request = args + [8080, 16, 200, 20][len(args):]
+    sub_edge_lookup = load_sub_edges_bundle(sub_edges_dir)
+
+    result = asyncio.run(load_test("127.0.0.1", test_port, sub_edge_lookup, clients,
+                                   requests_per_client, pairs_per_request))
+    print(json.dumps(result, indent=4))
@@ -6,13 +6,15 @@ from scipy import sparse
 from tqdm import tqdm
 from graph import *
 from edge_matrix import *
+from artifacts import *
     
-# Must-have
-edge_index = load_edge_index(index_file)
+# Must-have (one memory-mapped artifact directory, see artifacts.py)
+matrix_artifacts = load_matrix_artifacts(artifacts_dir)
+edge_index = matrix_artifacts.edge_index
 matrix_size = len(edge_index)
-total_sub_edges = load_total_sub_edges(total_sub_edges_file)
+sub_edge_lookup = matrix_artifacts.sub_edge_lookup
 
-inter_edges_matrix = load_inter_edges_matrix(matrix_file)
+inter_edges_matrix = matrix_artifacts.matrix
 
 edgeHistory = [["3342113667","6768412184"], ["5738080746","3220146382"], ["3915814322","5777195880"], ["5740180436","5755254579"],
                ["2240993963","9432516568"]]
@@ -23,8 +25,7 @@ edgeList = []
 
 print()
 
-for edge in edgeHistory:
-    corresponding_edge = total_sub_edges[tuple(edge)]
+for edge, corresponding_edge in zip(edgeHistory, sub_edge_lookup.lookup_ways(edgeHistory)):
     print(f"History sub_edge: {edge} -> edge (HoChiMinh.osm) : {corresponding_edge} -> index : {edge_index[str(corresponding_edge)]}")
     edgeList.append(str(corresponding_edge))
 
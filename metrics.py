@@ -0,0 +1,161 @@
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+
+"""
+[module: metrics]
+
+This module is used to instrument the build pipeline: named stage
+timers, counters (trips, unmapped sub-edges, pairs / triples emitted),
+peak-memory sampling and an optional cProfile hook per stage. Every
+finished stage is appended to a JSON-lines metrics log when one is set.
+
+EDGE_MATRIX_METRICS=output/metrics.jsonl  log file (off by default)
+EDGE_MATRIX_PROFILE=count_triples,merge_runs  stages to profile ('*' = all)
+"""
+
+metrics_file = 'output/metrics.jsonl'
+metrics_summary_file = 'output/metrics_summary.json'
+profile_dir = 'output/profiles'
+
+def get_rss_mb():
+    # Current resident set size (Linux /proc), 0 where unavailable
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError):
+        return 0.0
+
+def get_children_max_rss_mb():
+    # Largest peak RSS of any finished child process (pool workers), KiB on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+class MemorySampler(threading.Thread):
+    def __init__(self, interval=0.05):
+        super(MemorySampler, self).__init__(daemon=True)
+        self.interval = interval
+        self.peak = get_rss_mb()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, get_rss_mb())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, get_rss_mb())
+        return self.peak
+
+class Metrics:
+    def __init__(self):
+        self.log_file = os.environ.get('EDGE_MATRIX_METRICS') or None
+        self.profile_stages = set(filter(None, os.environ.get('EDGE_MATRIX_PROFILE', '').split(',')))
+        self.profile_dir = profile_dir
+        self.sample_interval = 0.05
+        self.stages = {}
+        self.counters = defaultdict(int)
+
+    def configure(self, log_file=None, profile_stages=(), profile_dir=profile_dir, sample_interval=0.05):
+        self.log_file = log_file
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir
+        self.sample_interval = sample_interval
+
+    def reset(self):
+        self.stages = {}
+        self.counters = defaultdict(int)
+
+    def count(self, name, n=1):
+        self.counters[name] += int(n)
+
+    def add_counts(self, counters):
+        for name, n in counters.items():
+            self.counters[name] += int(n)
+
+    def log(self, event, **fields):
+        if self.log_file is None:
+            return
+        os.makedirs(os.path.dirname(self.log_file) or '.', exist_ok=True)
+        with open(self.log_file, 'a') as f:
+            f.write(json.dumps({'time': time.time(), 'pid': os.getpid(), 'event': event, **fields}) + '\n')
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a block of the pipeline. Peak RSS is sampled in a background
+        thread; counters added during the block are attributed to the stage.
+        """
+        profiler = None
+        if name in self.profile_stages or '*' in self.profile_stages:
+            profiler = cProfile.Profile()
+        counters_before = dict(self.counters)
+        sampler = MemorySampler(self.sample_interval)
+        sampler.start()
+        rss_start = sampler.peak
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield self
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time.perf_counter() - start
+            peak = sampler.stop()
+
+            record = {
+                'seconds': seconds,
+                'rss_start_mb': rss_start,
+                'peak_rss_mb': peak,
+                'children_max_rss_mb': get_children_max_rss_mb(),
+                'counters': {key: value - counters_before.get(key, 0) for key, value in self.counters.items()
+                             if value != counters_before.get(key, 0)},
+            }
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                record['profile'] = os.path.join(self.profile_dir, f"{name}_{os.getpid()}.prof")
+                profiler.dump_stats(record['profile'])
+
+            # A stage run several times keeps totals and the highest peak
+            total = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_rss_mb': 0.0})
+            total['calls'] += 1
+            total['seconds'] += seconds
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], peak)
+            self.log('stage', stage=name, **record)
+
+    def timed(self, name):
+        # Decorator form of stage() for functions that are one stage as a whole
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def to_dict(self):
+        # ru_maxrss is the peak of the whole process so far, in KiB on Linux
+        return {'stages': self.stages, 'counters': dict(self.counters), 'rss_mb': get_rss_mb(),
+                'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                'children_max_rss_mb': get_children_max_rss_mb()}
+
+    def save(self, filename=metrics_summary_file):
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+        print(f"Save metrics to {filename} successfully")
+
+metrics = Metrics()
+
+# Log every stage of a build and profile the counting stage
+# metrics.configure(log_file=metrics_file, profile_stages=('count_triples',))
+# build_inter_edges_matrix_parallel(json_file, sub_edges_dir, edge_index)
+# metrics.save()
@@ -4,7 +4,11 @@ from folium import PolyLine
 import folium
 import osmnx as ox
 import json
+import os
+import numpy as np
 import xml.etree.ElementTree as ET
+from array import array
+from metrics import metrics
 
 
 """  
@@ -16,44 +20,176 @@ any given edges to draw GeoJSON file.
 """
 
 osm_file_name = "HoChiMinh.osm"
+node_coordinates_dir = "output/node_coordinates"
+
+def iter_osm_nodes(fileName):
+    # Stream <node> elements, clearing each one so the XML tree never builds up
+    context = ET.iterparse(f"osmFiles/{fileName}", events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event != 'end':
+            continue
+        if elem.tag == 'node':
+            yield elem.get('id'), float(elem.get('lat')), float(elem.get('lon'))
+        if elem.tag in ('node', 'way', 'relation'):
+            elem.clear()
+            root.clear()
 
 def get_all_node_coordinates(fileName):
-    tree = ET.parse(f"osmFiles/{fileName}")
-    root = tree.getroot()
-    
     node_coordinates = {}
     
-    for node in root.findall('node'):
-        node_id = node.get('id')
-        lat = float(node.get('lat'))
-        lon = float(node.get('lon'))
+    for node_id, lat, lon in iter_osm_nodes(fileName):
         node_coordinates[node_id] = (lat, lon)
     
     return node_coordinates
 
-busNetwork = VehicleQuery("bus_history.json")
-vehicle_history = busNetwork.vehicleList
-node_coordinates = get_all_node_coordinates(osm_file_name)
+class NodeCoordinates:
+    """
+    Sorted int64 node ids with float64 lat / lon, looked up for
+    whole arrays of node ids with one searchsorted.
+    """
+    def __init__(self, ids, lat, lon):
+        self.ids = ids
+        self.lat = lat
+        self.lon = lon
+
+    def lookup(self, node_ids):
+        # (lat, lon, found) for every node id; missing nodes get NaN
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            nan = np.full(node_ids.shape, np.nan)
+            return nan, nan.copy(), np.zeros(node_ids.shape, dtype=bool)
+        
+        pos = np.minimum(np.searchsorted(self.ids, node_ids), len(self.ids) - 1)
+        found = self.ids[pos] == node_ids
+        lat = np.where(found, self.lat[pos], np.nan)
+        lon = np.where(found, self.lon[pos], np.nan)
+        return lat, lon, found
 
-total_edges_nodes = []
-for vehicle in vehicle_history:
-    for trip in vehicle.getTripList:
-        total_edges_nodes.append(trip["edgesOfPath2"])
+NODE_COORDINATES_VERSION = 1
 
-total_edges_coordinates = []
-for trip in total_edges_nodes:
-    new_path = []
-    for edge in trip:
-        lat1, lon1 = node_coordinates[edge[0]]
-        lat2, lon2 = node_coordinates[edge[1]]
-        new_path.append([[lon1, lat1],[lon2, lat2]])
-    total_edges_coordinates.append(new_path)
+def save_node_coordinates(node_coordinates, dirname=node_coordinates_dir, fileName=None):
+    os.makedirs(dirname, exist_ok=True)
+    np.save(os.path.join(dirname, 'ids.npy'), node_coordinates.ids)
+    np.save(os.path.join(dirname, 'lat.npy'), node_coordinates.lat)
+    np.save(os.path.join(dirname, 'lon.npy'), node_coordinates.lon)
     
+    # Written last, so a cache cut off halfway is never taken as current
+    manifest = {'version': NODE_COORDINATES_VERSION, 'source': fileName}
+    if fileName is not None:
+        source = os.stat(f"osmFiles/{fileName}")
+        manifest.update({'source_size': source.st_size, 'source_mtime': source.st_mtime})
+    with open(os.path.join(dirname, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
 
+def is_node_coordinates_current(fileName, dirname=node_coordinates_dir):
+    try:
+        with open(os.path.join(dirname, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return False
+    source = os.stat(f"osmFiles/{fileName}")
+    return (manifest.get('version') == NODE_COORDINATES_VERSION and manifest.get('source') == fileName
+            and manifest.get('source_size') == source.st_size and manifest.get('source_mtime') == source.st_mtime)
 
+def load_node_coordinates(fileName, dirname=node_coordinates_dir):
+    # Memory-map the cached arrays; parse the OSM file again when it is not the one they came from
+    if is_node_coordinates_current(fileName, dirname):
+        return NodeCoordinates(*(np.load(os.path.join(dirname, f"{name}.npy"), mmap_mode='r')
+                                 for name in ('ids', 'lat', 'lon')))
+    
+    ids, lats, lons = array('q'), array('d'), array('d')
+    with metrics.stage('parse_osm_nodes'):
+        for node_id, lat, lon in iter_osm_nodes(fileName):
+            ids.append(int(node_id))
+            lats.append(lat)
+            lons.append(lon)
+        metrics.count('osm_nodes', len(ids))
+    
+    ids = np.frombuffer(ids, dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    node_coordinates = NodeCoordinates(ids[order], np.frombuffer(lats, dtype=np.float64)[order],
+                                       np.frombuffer(lons, dtype=np.float64)[order])
+    save_node_coordinates(node_coordinates, dirname, fileName)
+    
+    return node_coordinates
 
+def get_trip_lines(sub_edges, node_coordinates):
+    """
+    Merge consecutive sub-edges of a trip into lines of [lon, lat].
+    A new line starts wherever a sub-edge does not begin at the previous
+    one's end node (or a node has no coordinates).
+    """
+    nodes = np.asarray(sub_edges, dtype=np.int64).reshape(-1, 2)
+    lat, lon, found = node_coordinates.lookup(nodes)
+    valid = found.all(axis=1)
+    nodes, lat, lon = nodes[valid], lat[valid], lon[valid]
+    if len(nodes) == 0:
+        return []
+    
+    starts = np.ones(len(nodes), dtype=bool)
+    starts[1:] = nodes[1:, 0] != nodes[:-1, 1]
+    starts[1:] |= np.flatnonzero(valid)[1:] != np.flatnonzero(valid)[:-1] + 1
+    
+    # Each sub-edge adds its end node, and its start node only when it opens a line
+    keep = np.stack([starts, np.ones(len(nodes), dtype=bool)], axis=1).ravel()
+    coordinates = np.stack([lon.ravel(), lat.ravel()], axis=1)[keep]
+    line_ids = np.repeat(np.cumsum(starts), 1 + starts)
+    
+    bounds = np.flatnonzero(np.diff(line_ids)) + 1
+    return [line.tolist() for line in np.split(coordinates, bounds)]
 
+def iter_vehicle_trips(fileName):
+    with open(f"jsonFiles/{fileName}", "r") as file:
+        for line in file:
+            if line.strip():
+                vehicle = json.loads(line)
+                for trip_number, trip in enumerate(vehicle['tripList']):
+                    yield vehicle, trip_number, trip
 
+def get_trip_feature(vehicle, trip_number, trip, node_coordinates):
+    lines = get_trip_lines(trip["edgesOfPath2"], node_coordinates)
+    if len(lines) == 1:
+        geometry = {"type": "LineString", "coordinates": lines[0]}
+    else:
+        geometry = {"type": "MultiLineString", "coordinates": lines}
+    
+    return {
+        "type": "Feature",
+        "geometry": geometry,
+        "properties": {
+            "vehicleNumber": vehicle["vehicleNumber"],
+            "routeId": vehicle["routeId"],
+            "varId": vehicle["varId"],
+            "trip": trip_number,
+        },
+    }
 
+@metrics.timed('export_trips_geojson')
+def export_trips_geojson(fileName, output_file, node_coordinates, ndjson=False):
+    # Trips are written one at a time, so memory does not grow with the history
+    trip_count = 0
+    with open(output_file, "w") as out:
+        if not ndjson:
+            out.write('{"type": "FeatureCollection", "features": [\n')
+        
+        for vehicle, trip_number, trip in iter_vehicle_trips(fileName):
+            feature = get_trip_feature(vehicle, trip_number, trip, node_coordinates)
+            if not feature["geometry"]["coordinates"]:
+                metrics.count('trips_without_coordinates')
+                continue
+            if ndjson:
+                out.write(json.dumps(feature) + "\n")
+            else:
+                out.write((",\n" if trip_count else "") + json.dumps(feature))
+            trip_count += 1
+        
+        if not ndjson:
+            out.write("\n]}\n")
     
+    metrics.count('trips_exported', trip_count)
+    print(f"Export {trip_count} trips to {output_file} successfully")
 
+if __name__ == '__main__':
+    node_coordinates = load_node_coordinates(osm_file_name)
+    export_trips_geojson("bus_history.json", "output/bus_history.geojson", node_coordinates)
@@ -0,0 +1,180 @@
+import json
+import os
+import numpy as np
+from edge_matrix import *
+from shard_matrix import make_partition_label
+from artifacts import MatrixArtifacts
+
+
+"""
+[module: query]
+
+This module is used to answer "most frequent intermediate edge"
+queries on the saved inter_edges_matrix. The matrix and the
+edge_index are loaded once and every lookup is vectorized.
+"""
+
+def get_entry_keys(inter_edges_matrix):
+    # (row, col) of every stored entry as one sorted key, for batched searchsorted
+    indptr = inter_edges_matrix.indptr
+    rows = np.repeat(np.arange(inter_edges_matrix.shape[0], dtype=np.int64), np.diff(indptr))
+    return rows * inter_edges_matrix.shape[1] + inter_edges_matrix.indices
+
+def lookup_entries(entry_keys, data, rows, cols, edge_size):
+    # Stored value of every (row, col), 0 if the pair was never seen
+    if len(entry_keys) == 0:
+        return np.zeros(rows.shape, dtype=np.int64)
+
+    keys = rows * (edge_size + 1) + cols
+    pos = np.minimum(np.searchsorted(entry_keys, keys), len(entry_keys) - 1)
+    found = (entry_keys[pos] == keys) & (rows > 0) & (cols > 0)
+    return np.where(found, data[pos], 0).astype(np.int64)
+
+class InterEdgeIndex:
+    def __init__(self, matrix_file=matrix_file, index_file=index_file, top_k_file=None):
+        inter_edges_matrix = load_inter_edges_matrix(matrix_file).tocsr()
+        inter_edges_matrix.sort_indices()
+        # way id <-> matrix index, memory-mapped when the array form was saved
+        self.edge_index = open_edge_index(index_file)
+
+        self.edge_size = inter_edges_matrix.shape[0] - 1
+        self.indptr = inter_edges_matrix.indptr
+        self.indices = inter_edges_matrix.indices
+        self.data = inter_edges_matrix.data
+
+        self.entry_keys = get_entry_keys(inter_edges_matrix)
+
+        self.top_k = load_top_k(top_k_file) if top_k_file is not None else None
+
+    @classmethod
+    def from_artifacts(cls, matrix_artifacts):
+        # Everything memory-mapped from an artifact directory, nothing is rebuilt at load
+        if isinstance(matrix_artifacts, str):
+            matrix_artifacts = MatrixArtifacts(matrix_artifacts)
+        inter_edge_index = cls.__new__(cls)
+        inter_edge_index.edge_index = matrix_artifacts.edge_index
+        inter_edge_index.edge_size = matrix_artifacts.edge_size
+        inter_edges_matrix = matrix_artifacts.matrix
+        inter_edge_index.indptr = inter_edges_matrix.indptr
+        inter_edge_index.indices = inter_edges_matrix.indices
+        inter_edge_index.data = inter_edges_matrix.data
+        inter_edge_index.entry_keys = matrix_artifacts.entry_keys
+        inter_edge_index.top_k = matrix_artifacts.top_k
+        return inter_edge_index
+
+    def to_indices(self, way_ids):
+        # Matrix index of every way id, 0 if the way is not indexed
+        return self.edge_index.to_indices(way_ids)
+
+    def to_way_ids(self, indices):
+        # Way id of every matrix index, -1 for 0 / unknown
+        return self.edge_index.to_way_ids(indices)
+
+    def query_batch_indices(self, rows, cols):
+        # Stored intermediate index of every (row, col), 0 if the pair was never seen
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        return lookup_entries(self.entry_keys, self.data, rows, cols, self.edge_size)
+
+    def query_batch(self, pairs):
+        """
+        pairs: sequence of (edge_i, edge_j) way ids.
+        Returns the way id of the most frequent intermediate edge, -1 if none.
+        """
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        rows = self.to_indices(pairs[:, 0])
+        cols = self.to_indices(pairs[:, 1])
+        return self.to_way_ids(self.query_batch_indices(rows, cols))
+
+    def query(self, edge_i, edge_j):
+        intermediate = int(self.query_batch([(edge_i, edge_j)])[0])
+        return None if intermediate == -1 else intermediate
+
+    def query_top_k_batch(self, pairs):
+        """
+        Ranked candidates of every (edge_i, edge_j) way id pair (needs top_k_file).
+        Returns one list of (way_id, count, probability) per pair, empty if unseen.
+        """
+        if self.top_k is None:
+            raise ValueError("InterEdgeIndex was loaded without a top_k_file")
+
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        pair_keys = self.top_k['pair_keys']
+        offsets = self.top_k['offsets']
+        size = int(self.top_k['edge_size']) + 1
+        # An empty top-K (offsets == [0]) has nothing to index
+        if len(pair_keys) == 0:
+            return [[] for _ in range(len(pairs))]
+
+        rows = self.to_indices(pairs[:, 0])
+        cols = self.to_indices(pairs[:, 1])
+        keys = rows * size + cols
+        pos = np.minimum(np.searchsorted(pair_keys, keys), len(pair_keys) - 1)
+        found = (rows > 0) & (cols > 0) & (pair_keys[pos] == keys)
+
+        # Gather every candidate of the found pairs at once, then split per pair
+        lengths = np.where(found, offsets[pos + 1] - offsets[pos], 0)
+        starts = np.repeat(offsets[pos] - np.cumsum(lengths) + lengths, lengths)
+        slots = starts + np.arange(lengths.sum())
+        way_ids = self.to_way_ids(self.top_k['inters'][slots])
+        counts = self.top_k['counts'][slots].astype(np.int64)
+        probabilities = counts / np.repeat(self.top_k['totals'][pos], lengths)
+
+        candidates = list(zip(way_ids.tolist(), counts.tolist(), probabilities.tolist()))
+        bounds = np.cumsum(lengths)
+        return [candidates[end - length:end] for end, length in zip(bounds.tolist(), lengths.tolist())]
+
+    def query_top_k(self, edge_i, edge_j):
+        return self.query_top_k_batch([(edge_i, edge_j)])[0]
+
+class ShardedInterEdgeIndex(InterEdgeIndex):
+    """
+    Queries on a shard directory (shard_matrix.build_sharded_matrices).
+    The shard is picked from the partition values of the query; shards with
+    fewer than `min_trips` trips, and pairs a shard never saw, fall back to
+    the global matrix.
+    """
+    def __init__(self, shards_dir, index_file=index_file, min_trips=50):
+        with open(os.path.join(shards_dir, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+        super().__init__(os.path.join(shards_dir, self.manifest['global']['file']), index_file)
+
+        self.shards_dir = shards_dir
+        self.min_trips = min_trips
+        self.shard_info = {shard['label']: shard for shard in self.manifest['shards']}
+        self.shards = {}
+
+    def get_shard(self, label):
+        shard = self.shard_info.get(label)
+        if shard is None or shard['trips'] < self.min_trips:
+            return None
+        if label not in self.shards:
+            inter_edges_matrix = sparse.load_npz(os.path.join(self.shards_dir, shard['file'])).tocsr()
+            inter_edges_matrix.sort_indices()
+            self.shards[label] = (get_entry_keys(inter_edges_matrix), inter_edges_matrix.data)
+        return self.shards[label]
+
+    def query_batch(self, pairs, **partition_values):
+        """
+        pairs: sequence of (edge_i, edge_j) way ids, partition_values: e.g.
+        routeId=..., hour=... (the fields the shards were built with). Without
+        every one of those fields the global matrix answers.
+        """
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        rows = self.to_indices(pairs[:, 0])
+        cols = self.to_indices(pairs[:, 1])
+        intermediates = self.query_batch_indices(rows, cols)
+
+        shard = None
+        if all(partition_values.get(field) is not None for field in self.manifest['partition']):
+            label = make_partition_label(self.manifest['partition'], self.manifest['hour_bucket'], **partition_values)
+            shard = self.get_shard(label)
+        if shard is not None:
+            shard_intermediates = lookup_entries(*shard, rows, cols, self.edge_size)
+            intermediates = np.where(shard_intermediates > 0, shard_intermediates, intermediates)
+
+        return self.to_way_ids(intermediates)
+
+    def query(self, edge_i, edge_j, **partition_values):
+        intermediate = int(self.query_batch([(edge_i, edge_j)], **partition_values)[0])
+        return None if intermediate == -1 else intermediate
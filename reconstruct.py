@@ -0,0 +1,205 @@
+import numpy as np
+import networkx as nx
+from edge_matrix import *
+from query import InterEdgeIndex
+
+
+"""
+[module: path_reconstruction]
+
+This module is used to densify sparse edge traces with the
+inter_edges_matrix. Between two observed ways A and B the stored
+intermediate K is inserted, then (A, K) and (K, B) are split again,
+until the matrix has nothing in between. Matrix lookups for a whole
+batch of traces are done level by level with one vectorized search,
+split results are memoized across traces. An intermediate that is
+already on the path of the current gap (cycle) is not inserted again,
+and a gap stops splitting past max_depth or after max_gap_ways
+inserted ways, so the work per observed pair stays bounded.
+
+When an observed pair has no entry at all, the gap is filled with a
+shortest path on the road graph (GraphFallback).
+"""
+
+class GraphFallback:
+    """
+    Shortest path between two ways on the graph of graph.create_graph_from_osm
+    (one edge per way, first -> last node). Travel direction on a way is not
+    known, so the graph is used undirected and every end of A is tried
+    against every end of B. Returns the way ids strictly between A and B,
+    or None when they are not connected.
+    """
+    def __init__(self, G, total_edges):
+        self.graph = G.to_undirected(as_view=True)
+        self.way_ends = {int(way_id): (nodes[0], nodes[-1]) for way_id, nodes in total_edges.items()}
+
+    def get_way_between(self, u, v):
+        # Any way linking two consecutive nodes of a node path
+        return next(iter(self.graph.get_edge_data(u, v).values()))['wayid']
+
+    def __call__(self, from_way, to_way):
+        if from_way not in self.way_ends or to_way not in self.way_ends:
+            return None
+        best = None
+        for source in set(self.way_ends[from_way]):
+            for target in set(self.way_ends[to_way]):
+                try:
+                    nodes = nx.shortest_path(self.graph, source, target)
+                except (nx.NetworkXNoPath, nx.NodeNotFound):
+                    continue
+                if best is None or len(nodes) < len(best):
+                    best = nodes
+        if best is None:
+            return None
+        ways = [int(self.get_way_between(u, v)) for u, v in zip(best[:-1], best[1:])]
+        return [way for way in ways if way != from_way and way != to_way]
+
+class PathReconstructor:
+    def __init__(self, inter_edge_index, fallback=None, max_depth=12, max_gap_ways=256, cache_size=1 << 20):
+        """
+        inter_edge_index  query.InterEdgeIndex (or an artifact directory / MatrixArtifacts)
+        fallback          callable(from_way_id, to_way_id) -> way ids between, or None;
+                          only used for observed pairs without a matrix entry
+        max_depth         deepest split of one observed pair
+        max_gap_ways      most ways inserted between one observed pair
+        cache_size        memoized pairs kept before the cache is cleared
+        """
+        if not isinstance(inter_edge_index, InterEdgeIndex):
+            inter_edge_index = InterEdgeIndex.from_artifacts(inter_edge_index)
+        self.inter_edge_index = inter_edge_index
+        self.size = inter_edge_index.edge_size + 1
+        self.fallback = fallback
+        self.max_depth = max_depth
+        self.max_gap_ways = max_gap_ways
+        self.cache_size = cache_size
+
+        # pair key (a * size + b) -> stored intermediate index / densified index path / fallback path
+        self.intermediates = {}
+        self.paths = {}
+        self.fallback_paths = {}
+
+    def clear_cache(self):
+        self.intermediates.clear()
+        self.paths.clear()
+        self.fallback_paths.clear()
+
+    def prefetch(self, rows, cols):
+        """
+        Look up the intermediates of the given pairs and of every pair they
+        split into, one vectorized query per level, down to max_depth.
+        """
+        keys = np.unique(np.asarray(rows, dtype=np.int64) * self.size + np.asarray(cols, dtype=np.int64))
+        for _ in range(self.max_depth + 1):
+            keys = np.array([key for key in keys.tolist() if key not in self.intermediates], dtype=np.int64)
+            if len(keys) == 0:
+                break
+            rows, cols = keys // self.size, keys % self.size
+            inters = self.inter_edge_index.query_batch_indices(rows, cols)
+            self.intermediates.update(zip(keys.tolist(), inters.tolist()))
+
+            split = (inters > 0) & (inters != rows) & (inters != cols)
+            rows, cols, inters = rows[split], cols[split], inters[split]
+            keys = np.unique(np.concatenate([rows * self.size + inters, inters * self.size + cols]))
+
+    def get_fallback_path(self, a, b):
+        if self.fallback is None:
+            return []
+        key = a * self.size + b
+        if key not in self.fallback_paths:
+            from_way, to_way = self.inter_edge_index.to_way_ids(np.array([a, b])).tolist()
+            ways = self.fallback(from_way, to_way) or []
+            indices = self.inter_edge_index.to_indices(np.array(ways, dtype=np.int64))
+            self.fallback_paths[key] = indices[indices > 0].tolist()
+        return self.fallback_paths[key]
+
+    def expand(self, a, b, visited, budget, depth=0, observed=False):
+        """
+        Index path strictly between a and b, whether it is exact (not cut by
+        a cycle, max_depth or the gap's way budget) and its split height.
+        `visited` holds the ways already on the gap's path and `budget` the
+        ways the gap may still insert. A memoized path is reused only where
+        recomputing it would give the same result: none of its ways visited,
+        its height within the remaining depth and its length within the
+        budget, so results never depend on trace order.
+        """
+        key = a * self.size + b
+        inter = self.intermediates.get(key)
+        if inter is None:
+            self.prefetch([a], [b])
+            inter = self.intermediates[key]
+
+        # Nothing stored: a pair made by a split is adjacent, an observed pair is a real gap
+        if inter == 0 or inter == a or inter == b:
+            return (self.get_fallback_path(a, b) if observed and inter == 0 else []), True, 0
+        cached = self.paths.get(key)
+        if (cached is not None and depth + cached[2] <= self.max_depth and len(cached[0]) <= budget[0]
+                and cached[1].isdisjoint(visited)):
+            visited.update(cached[1])
+            budget[0] -= len(cached[0])
+            return cached[0], True, cached[2]
+        if inter in visited or depth >= self.max_depth or budget[0] <= 0:
+            return [], False, 0
+
+        visited.add(inter)
+        budget[0] -= 1
+        left, left_exact, left_height = self.expand(a, inter, visited, budget, depth + 1)
+        right, right_exact, right_height = self.expand(inter, b, visited, budget, depth + 1)
+        path = left + [inter] + right
+        if not (left_exact and right_exact):
+            return path, False, 0
+
+        height = 1 + max(left_height, right_height)
+        self.paths[key] = (path, frozenset(path), height)
+        return path, True, height
+
+    def reconstruct_indices(self, indices):
+        # Densified index path of one trace of matrix indices (0 = unknown way, kept but never filled)
+        if len(indices) == 0:
+            return []
+        path = [indices[0]]
+        for a, b in zip(indices[:-1], indices[1:]):
+            if a > 0 and b > 0 and a != b:
+                path.extend(self.expand(a, b, {a, b}, [self.max_gap_ways], observed=True)[0])
+            path.append(b)
+        return path
+
+    def reconstruct_batch(self, traces):
+        """
+        Densify many traces (lists of way ids) at once. Returns one list of
+        way ids per trace; unknown way ids are kept as they are.
+        """
+        if len(self.paths) + len(self.intermediates) + len(self.fallback_paths) > self.cache_size:
+            self.clear_cache()
+
+        lengths = [len(trace) for trace in traces]
+        way_ids = np.fromiter((way for trace in traces for way in trace), dtype=np.int64, count=sum(lengths))
+        indices = self.inter_edge_index.to_indices(way_ids)
+
+        # Every observed pair of the batch in one go
+        pairs = (indices[:-1] > 0) & (indices[1:] > 0) & (indices[:-1] != indices[1:])
+        boundaries = np.cumsum(lengths)[:-1] - 1
+        pairs[boundaries[(boundaries >= 0) & (boundaries < len(pairs))]] = False
+        self.prefetch(indices[:-1][pairs], indices[1:][pairs])
+
+        results = []
+        start = 0
+        for length in lengths:
+            trace_indices = indices[start:start + length].tolist()
+            path = np.array(self.reconstruct_indices(trace_indices), dtype=np.int64)
+            known = path > 0
+            # Unknown ways map back to their own id
+            path_way_ids = self.inter_edge_index.to_way_ids(path)
+            path_way_ids[~known] = way_ids[start:start + length][indices[start:start + length] == 0]
+            results.append(path_way_ids.tolist())
+            start += length
+        return results
+
+    def reconstruct(self, trace):
+        return self.reconstruct_batch([trace])[0]
+
+# Densify traces with the matrix, networkx shortest path where it has no entry
+# G, total_edges = create_graph_from_osm(osm_file)
+# path_reconstructor = PathReconstructor(InterEdgeIndex(), GraphFallback(G, total_edges))
+# path_reconstructor.reconstruct_batch([[24403452, 24403453, 24403460], ...])
+# Faster fallback: the way-adjacency CSR graph of road_graph.py
+# path_reconstructor = PathReconstructor(InterEdgeIndex(), load_way_graph(open_edge_index(index_file)))
@@ -0,0 +1,303 @@
+import heapq
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import csgraph
+from edge_matrix import *
+
+
+"""
+[module: road_graph]
+
+This module is used to answer shortest-path queries between ways
+when the inter_edges_matrix has no entry for a pair. Every highway
+way is a vertex (numbered as in edge_index, 0 unused) and two ways
+are linked when they share any node, not only first / last nodes as
+in create_graph_from_osm. The link u - v costs half the length of u
+plus half the length of v (meters, from node coordinates), so a path
+costs the length of its inner ways plus half of both ends.
+
+The graph is a scipy CSR matrix: batches of sources go through
+csgraph.dijkstra in chunks of at most cache_size sources, recent source
+trees stay in an LRU cache and point-to-point queries use A* with
+landmark (ALT) lower bounds.
+"""
+
+way_graph_dir = 'output/way_graph'
+WAY_GRAPH_FORMAT_VERSION = 1
+EARTH_RADIUS = 6371008.8
+
+def get_way_lengths(osm_arrays):
+    # Length in meters of every way (haversine over consecutive nodes)
+    node_pos = np.searchsorted(osm_arrays.nodes, osm_arrays.way_nodes)
+    lat = np.radians(osm_arrays.lat[node_pos])
+    lon = np.radians(osm_arrays.lon[node_pos])
+    a = (np.sin((lat[1:] - lat[:-1]) / 2) ** 2
+         + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin((lon[1:] - lon[:-1]) / 2) ** 2)
+    steps = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+    # A step between the last node of a way and the first of the next one is not part of any way
+    way = np.repeat(np.arange(len(osm_arrays.ways)), np.diff(osm_arrays.way_offsets))
+    same_way = way[1:] == way[:-1]
+    steps = np.where(same_way & np.isfinite(steps), steps, 0)
+    return np.bincount(way[1:], weights=steps, minlength=len(osm_arrays.ways))
+
+def get_shared_node_pairs(way_nodes, way_index):
+    # Every ordered pair (way u, way v), u != v, of ways that share a node
+    order = np.lexsort((way_index, way_nodes))
+    nodes, ways = way_nodes[order], way_index[order]
+    keep = np.ones(len(nodes), dtype=bool)
+    keep[1:] = (nodes[1:] != nodes[:-1]) | (ways[1:] != ways[:-1])
+    nodes, ways = nodes[keep], ways[keep]
+
+    starts = np.flatnonzero(np.r_[True, nodes[1:] != nodes[:-1]])
+    sizes = np.diff(np.r_[starts, len(nodes)])
+    shared = sizes > 1
+    starts, sizes = starts[shared], sizes[shared]
+
+    # Each member of a group of size g is paired with the g members of its group
+    members = np.repeat(starts, sizes) + (np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes))
+    member_sizes = np.repeat(sizes, sizes)
+    left = np.repeat(members, member_sizes)
+    right = np.repeat(np.repeat(starts, sizes), member_sizes) + (
+        np.arange(member_sizes.sum()) - np.repeat(np.cumsum(member_sizes) - member_sizes, member_sizes))
+    distinct = left != right
+    return ways[left[distinct]], ways[right[distinct]]
+
+class WayGraph:
+    def __init__(self, graph, lengths, edge_index, cache_size=256):
+        """
+        graph       (edge_size + 1) x (edge_size + 1) CSR matrix of link costs
+        lengths     way length in meters per matrix index (0 at index 0)
+        edge_index  edge_index (dict or EdgeIndexArrays) of the inter_edges_matrix
+        cache_size  source trees (distances + predecessors) kept in the LRU cache
+        """
+        if not isinstance(edge_index, EdgeIndexArrays):
+            edge_index = EdgeIndexArrays.from_edge_index(edge_index)
+        self.graph = graph
+        self.lengths = lengths
+        self.edge_index = edge_index
+        self.cache_size = cache_size
+        self.trees = OrderedDict()
+        self.landmarks = None
+        self.landmark_dist = None
+
+    @classmethod
+    def from_osm_arrays(cls, osm_arrays, edge_index, cache_size=256):
+        if not isinstance(edge_index, EdgeIndexArrays):
+            edge_index = EdgeIndexArrays.from_edge_index(edge_index)
+        size = len(edge_index) + 1
+        indices = edge_index.to_indices(osm_arrays.ways)
+
+        lengths = np.zeros(size, dtype=np.float64)
+        lengths[indices[indices > 0]] = get_way_lengths(osm_arrays)[indices > 0]
+
+        # Ways missing from edge_index get index 0 and are left out
+        way_index = np.repeat(indices, np.diff(osm_arrays.way_offsets))
+        indexed = way_index > 0
+        rows, cols = get_shared_node_pairs(osm_arrays.way_nodes[indexed], way_index[indexed])
+        keys = np.unique(rows.astype(np.int64) * size + cols)
+        rows, cols = keys // size, keys % size
+
+        # Zero-length ways still need a positive cost, csgraph drops explicit zeros
+        costs = np.maximum((lengths[rows] + lengths[cols]) / 2, 1e-3)
+        graph = sparse.csr_matrix((costs, (rows, cols)), shape=(size, size))
+        return cls(graph, lengths, edge_index, cache_size)
+
+    def to_indices(self, way_ids):
+        return self.edge_index.to_indices(way_ids)
+
+    def get_trees(self, sources):
+        """
+        (distances, predecessors) of every source. Uncached sources go through
+        dijkstra in chunks of at most cache_size (each chunk is a dense
+        sources x V array), and the cache never holds more than cache_size
+        trees; query_batch asks for one chunk at a time.
+        """
+        sources = [int(source) for source in sources]
+        trees = {}
+        for source in dict.fromkeys(sources):
+            if source in self.trees:
+                self.trees.move_to_end(source)
+                trees[source] = self.trees[source]
+        missing = [source for source in dict.fromkeys(sources) if source not in trees]
+        step = max(self.cache_size, 1)
+        for start in range(0, len(missing), step):
+            chunk = missing[start:start + step]
+            dist, pred = csgraph.dijkstra(self.graph, indices=chunk, return_predecessors=True)
+            for i, source in enumerate(chunk):
+                # Copies, so a cached row does not keep its whole chunk alive
+                trees[source] = self.trees[source] = (dist[i].copy(), pred[i].copy())
+            del dist, pred
+            while len(self.trees) > self.cache_size:
+                self.trees.popitem(last=False)
+        return [trees[source] for source in sources]
+
+    def get_tree_path(self, pred, source, target):
+        # Index path source -> target from a predecessor row, None if unreachable
+        if source == target:
+            return [source]
+        if pred[target] < 0:
+            return None
+        path = [target]
+        while path[-1] != source:
+            path.append(int(pred[path[-1]]))
+        return path[::-1]
+
+    def query_batch(self, pairs):
+        """
+        Shortest paths for many (from_way_id, to_way_id) pairs, grouped by
+        source. Returns (distances between way centers in meters, inner way ids
+        per pair); inf and None for pairs that are unknown or not connected.
+        """
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        rows, cols = self.to_indices(pairs[:, 0]), self.to_indices(pairs[:, 1])
+        known = (rows > 0) & (cols > 0)
+        distances = np.full(len(pairs), np.inf)
+        paths = [None] * len(pairs)
+
+        # Pairs grouped by source; the trees of one chunk of sources are used up before the next
+        queried = np.flatnonzero(known)
+        queried = queried[np.argsort(rows[queried], kind='stable')]
+        sources, starts = np.unique(rows[queried], return_index=True)
+        bounds = np.r_[starts, len(queried)]
+        step = max(self.cache_size, 1)
+        for start in range(0, len(sources), step):
+            chunk = sources[start:start + step].tolist()
+            for s, (dist, pred) in enumerate(self.get_trees(chunk), start):
+                for i in queried[bounds[s]:bounds[s + 1]].tolist():
+                    path = self.get_tree_path(pred, int(rows[i]), int(cols[i]))
+                    if path is not None:
+                        distances[i] = dist[cols[i]]
+                        paths[i] = self.edge_index.to_way_ids(path[1:-1]).tolist()
+        return distances, paths
+
+    def precompute_landmarks(self, n_landmarks=16, seed=0):
+        """
+        Pick landmarks by farthest-point sampling and keep their distance to
+        every way (V x n_landmarks). Links are symmetric, so for any landmark
+        |d(l, target) - d(l, v)| is a lower bound of d(v, target).
+        """
+        degree = np.diff(self.graph.indptr)
+        candidates = np.flatnonzero(degree > 0)
+        if len(candidates) == 0:
+            return
+        start = int(np.random.default_rng(seed).choice(candidates))
+        nearest = csgraph.dijkstra(self.graph, indices=[start])[0]
+
+        landmarks = []
+        landmark_dist = []
+        for _ in range(min(n_landmarks, len(candidates))):
+            # Farthest way (reachable from the landmarks so far) from all of them
+            score = np.where(np.isfinite(nearest), nearest, -1.0)
+            score[degree == 0] = -1.0
+            score[landmarks] = -1.0
+            landmark = int(np.argmax(score))
+            if score[landmark] <= 0:
+                break
+            landmarks.append(landmark)
+            landmark_dist.append(csgraph.dijkstra(self.graph, indices=[landmark])[0])
+            nearest = np.minimum(nearest, landmark_dist[-1]) if len(landmarks) > 1 else landmark_dist[-1]
+
+        self.landmarks = np.array(landmarks, dtype=np.int64)
+        self.landmark_dist = np.ascontiguousarray(np.stack(landmark_dist, axis=1)) if landmarks else None
+
+    def get_lower_bound(self, node, target_dist):
+        if self.landmark_dist is None:
+            return 0.0
+        with np.errstate(invalid='ignore'):
+            bounds = np.abs(target_dist - self.landmark_dist[node])
+        # inf: node and target lie in different components for some landmark
+        return float(np.nanmax(bounds)) if not np.all(np.isnan(bounds)) else 0.0
+
+    def find_path(self, source, target):
+        """
+        A* from source to target index with landmark bounds (plain Dijkstra
+        order without landmarks). Returns (distance between the two way
+        centers, index path) or (inf, None).
+        """
+        if source == target:
+            return 0.0, [source]
+        indptr, indices, data = self.graph.indptr, self.graph.indices, self.graph.data
+        target_dist = self.landmark_dist[target] if self.landmark_dist is not None else None
+
+        dist = {source: 0.0}
+        pred = {source: -1}
+        closed = set()
+        heap = [(self.get_lower_bound(source, target_dist), source)]
+        while heap:
+            _, node = heapq.heappop(heap)
+            if node in closed:
+                continue
+            if node == target:
+                path = [node]
+                while pred[path[-1]] >= 0:
+                    path.append(pred[path[-1]])
+                return dist[node], path[::-1]
+            closed.add(node)
+            start, end = indptr[node], indptr[node + 1]
+            for neighbor, cost in zip(indices[start:end].tolist(), data[start:end].tolist()):
+                candidate = dist[node] + cost
+                if neighbor in closed or candidate >= dist.get(neighbor, np.inf):
+                    continue
+                bound = self.get_lower_bound(neighbor, target_dist)
+                if bound == np.inf:
+                    continue
+                dist[neighbor] = candidate
+                pred[neighbor] = node
+                heapq.heappush(heap, (candidate + bound, neighbor))
+        return np.inf, None
+
+    def __call__(self, from_way, to_way):
+        # Fallback interface of reconstruct.PathReconstructor: inner way ids or None
+        source, target = self.to_indices(np.array([from_way, to_way])).tolist()
+        if source == 0 or target == 0:
+            return None
+        if self.landmark_dist is None:
+            return self.query_batch([[from_way, to_way]])[1][0]
+        _, path = self.find_path(source, target)
+        return None if path is None else self.edge_index.to_way_ids(path[1:-1]).tolist()
+
+def save_way_graph(way_graph, dirname=way_graph_dir):
+    graph = way_graph.graph.tocsr()
+    os.makedirs(dirname, exist_ok=True)
+    np.save(os.path.join(dirname, 'indptr.npy'), graph.indptr)
+    np.save(os.path.join(dirname, 'indices.npy'), graph.indices)
+    np.save(os.path.join(dirname, 'data.npy'), graph.data)
+    np.save(os.path.join(dirname, 'lengths.npy'), way_graph.lengths)
+    if way_graph.landmarks is not None:
+        np.save(os.path.join(dirname, 'landmarks.npy'), way_graph.landmarks)
+        np.save(os.path.join(dirname, 'landmark_dist.npy'), way_graph.landmark_dist)
+    with open(os.path.join(dirname, 'manifest.json'), 'w') as f:
+        json.dump({'format': 'way_graph', 'version': WAY_GRAPH_FORMAT_VERSION, 'ways': graph.shape[0] - 1,
+                   'links': int(graph.nnz), 'landmarks': 0 if way_graph.landmarks is None
+                   else len(way_graph.landmarks)}, f)
+    print("Save way_graph successfully")
+
+def load_way_graph(edge_index, dirname=way_graph_dir, mmap_mode='r', cache_size=256):
+    with open(os.path.join(dirname, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('format') != 'way_graph' or manifest.get('version') != WAY_GRAPH_FORMAT_VERSION:
+        raise ValueError(f"Unsupported way_graph in {dirname}: {manifest}")
+    if manifest['ways'] != len(edge_index):
+        raise ValueError(f"way_graph has {manifest['ways']} ways, edge_index has {len(edge_index)}")
+
+    def load(name):
+        return np.load(os.path.join(dirname, f"{name}.npy"), mmap_mode=mmap_mode)
+
+    size = manifest['ways'] + 1
+    graph = sparse.csr_matrix((load('data'), load('indices'), load('indptr')), shape=(size, size), copy=False)
+    way_graph = WayGraph(graph, load('lengths'), edge_index, cache_size)
+    if manifest['landmarks']:
+        way_graph.landmarks = load('landmarks')
+        way_graph.landmark_dist = load('landmark_dist')
+    print("Load way_graph successfully")
+    return way_graph
+
+# Build once from the lean OSM arrays, then use it as the reconstruction fallback
+# edge_index = open_edge_index(index_file)
+# way_graph = WayGraph.from_osm_arrays(load_osm_arrays(osm_file), edge_index)
+# way_graph.precompute_landmarks(16)
+# save_way_graph(way_graph)
+# path_reconstructor = PathReconstructor(InterEdgeIndex(), load_way_graph(edge_index))
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+from query import *
+from artifacts import artifacts_dir, load_matrix_artifacts
+
+
+"""
+[module: server]
+
+This module is used to serve the inter_edges_matrix over HTTP.
+The matrix, edge_index and sub_edges bundle stay in memory, and
+concurrent requests are coalesced into one vectorized lookup.
+
+POST /query  {"pairs": [[[u1, v1], [u2, v2]], ...]}  (sub-edge pairs)
+GET  /stats  latency / throughput counters
+"""
+
+host = "127.0.0.1"
+port = 8080
+
+class ServerStats:
+    def __init__(self, window=10000):
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.pairs = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=window)
+
+    def record(self, n_pairs, latency):
+        self.requests += 1
+        self.pairs += n_pairs
+        self.latencies.append(latency)
+
+    def to_dict(self):
+        uptime = time.time() - self.started
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            'uptime_s': uptime,
+            'requests': self.requests,
+            'errors': self.errors,
+            'pairs': self.pairs,
+            'batches': self.batches,
+            'pairs_per_batch': self.pairs / self.batches if self.batches else 0,
+            'requests_per_s': self.requests / uptime if uptime else 0,
+            'pairs_per_s': self.pairs / uptime if uptime else 0,
+            'latency_ms': {
+                'mean': float(latencies.mean()),
+                'p50': float(np.percentile(latencies, 50)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max()),
+            },
+        }
+
+class InterEdgeServer:
+    def __init__(self, inter_edge_index, sub_edge_lookup, max_delay=0.002, max_batch_pairs=50000):
+        self.inter_edge_index = inter_edge_index
+        self.sub_edge_lookup = sub_edge_lookup
+        self.max_delay = max_delay
+        self.max_batch_pairs = max_batch_pairs
+        self.stats = ServerStats()
+        self.queue = None
+
+    def resolve(self, pairs):
+        # pairs: (n, 2, 2) node ids -> way ids of both sub-edges and the intermediate
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2, 2)
+        ways = self.sub_edge_lookup.lookup_ways(pairs.reshape(-1, 2)).reshape(-1, 2)
+        intermediates = self.inter_edge_index.query_batch(ways)
+        return ways, intermediates
+
+    async def coalesce(self):
+        # Drain every request that arrives within max_delay into one lookup
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            n_pairs = len(batch[0][0])
+            deadline = loop.time() + self.max_delay
+            while n_pairs < self.max_batch_pairs:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(request)
+                n_pairs += len(request[0])
+
+            try:
+                ways, intermediates = self.resolve(np.concatenate([pairs for pairs, _ in batch]))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.stats.batches += 1
+
+            start = 0
+            for pairs, future in batch:
+                end = start + len(pairs)
+                future.set_result((ways[start:end], intermediates[start:end]))
+                start = end
+
+    async def handle_query(self, body):
+        pairs = np.asarray(json.loads(body)['pairs'], dtype=np.int64).reshape(-1, 2, 2)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((pairs, future))
+        ways, intermediates = await future
+        return {'ways': ways.tolist(), 'intermediates': intermediates.tolist()}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode().partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                start = time.perf_counter()
+                status = '200 OK'
+                try:
+                    if method == 'POST' and path == '/query':
+                        response = await self.handle_query(body)
+                        self.stats.record(len(response['intermediates']), time.perf_counter() - start)
+                    elif method == 'GET' and path == '/stats':
+                        response = self.stats.to_dict()
+                    else:
+                        status = '404 Not Found'
+                        response = {'error': f"Unknown route {method} {path}"}
+                except (ValueError, KeyError, TypeError, OverflowError) as e:
+                    # Malformed body, e.g. node ids beyond int64 or pairs of the wrong shape
+                    self.stats.errors += 1
+                    status = '400 Bad Request'
+                    response = {'error': str(e)}
+
+                payload = json.dumps(response).encode()
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+                await writer.drain()
+
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError, OverflowError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=host, port=port):
+        self.queue = asyncio.Queue()
+        coalescer = asyncio.create_task(self.coalesce())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving inter_edges_matrix on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            coalescer.cancel()
+
+if __name__ == '__main__':
+    serve_port = int(sys.argv[1]) if len(sys.argv) > 1 else port
+    if os.path.exists(os.path.join(artifacts_dir, 'manifest.json')):
+        matrix_artifacts = load_matrix_artifacts(artifacts_dir)
+        inter_edge_server = InterEdgeServer(InterEdgeIndex.from_artifacts(matrix_artifacts),
+                                            matrix_artifacts.sub_edge_lookup)
+    else:
+        inter_edge_server = InterEdgeServer(InterEdgeIndex(matrix_file, index_file),
+                                            load_sub_edges_bundle(sub_edges_dir))
+    asyncio.run(inter_edge_server.serve(host, serve_port))
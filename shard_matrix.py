@@ -0,0 +1,212 @@
+import json
+import os
+import time
+import numpy as np
+from edge_matrix import *
+from edge_matrix import _worker_state
+
+
+"""
+[module: sharded_matrix]
+
+This module is used to build a family of inter_edges_matrix shards,
+one per partition of the trips (routeId, varId, vehicleNumber and/or
+hour-of-day bucket), in a single pass over bus_history. The shards and
+the global matrix are stored in one directory with a manifest.
+"""
+
+shards_dir = 'output/inter_edges_shards'
+SHARDS_VERSION = 1
+PARTITION_FIELDS = ('routeId', 'varId', 'vehicleNumber', 'hour')
+
+def get_trip_hour(trip, time_field='timeStamp', utc_offset=7):
+    # Local hour of the trip's first timestamp (epoch s or ms), None if missing
+    timestamp = trip.get(time_field)
+    if isinstance(timestamp, list):
+        timestamp = timestamp[0] if timestamp else None
+    if timestamp is None:
+        return None
+    timestamp = float(timestamp)
+    if timestamp > 1e12:
+        timestamp /= 1000
+    return int(timestamp // 3600 + utc_offset) % 24
+
+def get_partition_label(vehicle, trip, partition, hour_bucket=1, time_field='timeStamp', utc_offset=7):
+    parts = []
+    for field in partition:
+        if field == 'hour':
+            hour = get_trip_hour(trip, time_field, utc_offset)
+            value = 'unknown' if hour is None else hour // hour_bucket * hour_bucket
+        else:
+            value = vehicle[field]
+        parts.append(f"{field}={value}")
+    return '|'.join(parts)
+
+def make_partition_label(partition, hour_bucket=1, **values):
+    # Query-side label, same format as get_partition_label
+    parts = []
+    for field in partition:
+        value = values[field]
+        if field == 'hour':
+            value = value // hour_bucket * hour_bucket
+        parts.append(f"{field}={value}")
+    return '|'.join(parts)
+
+def init_shard_worker(sub_edge_index, edge_size, windows, max_triples, dedupe, partition_config):
+    init_worker(sub_edge_index, edge_size, windows, max_triples, dedupe)
+    _worker_state['partition_config'] = partition_config
+
+def process_shard_chunk(chunk_id, lines):
+    # Keys get the chunk-local shard id above the (row, col, intermediate) key
+    sub_edge_index = _worker_state['sub_edge_index']
+    edge_size = _worker_state['edge_size']
+    triple_space = (edge_size + 1) ** 3
+
+    labels = {}
+    trip_counts = []
+    keys = []
+    weights = []
+    for line in lines:
+        vehicle = json.loads(line)
+        for trip in vehicle['tripList']:
+            label = get_partition_label(vehicle, trip, **_worker_state['partition_config'])
+            if label not in labels:
+                labels[label] = len(labels)
+                trip_counts.append(0)
+            shard = labels[label]
+            trip_counts[shard] += 1
+            trip_keys, trip_weights = get_trip_keys(encode_trip(trip, sub_edge_index, _worker_state['dedupe']), edge_size,
+                                                    _worker_state['windows'], _worker_state['max_triples'])
+            keys.append(trip_keys + shard * triple_space)
+            weights.append(trip_weights)
+
+    if all(trip_weights is None for trip_weights in weights):
+        weights = None
+    else:
+        weights = np.concatenate([np.ones(len(trip_keys), dtype=np.int64) if trip_weights is None else trip_weights
+                                  for trip_keys, trip_weights in zip(keys, weights)])
+    keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+    return count_triple_keys(keys, chunk_id << CHUNK_ORDER_BITS, weights), list(labels), trip_counts
+
+class ShardCollector:
+    def __init__(self, edge_size, memory_budget, spill_dir):
+        self.triple_space = (edge_size + 1) ** 3
+        self.partial_counts = PartialCounts(memory_budget, spill_dir)
+        self.labels = {}
+        self.trips = []
+
+    def add(self, result):
+        (keys, counts, first), labels, trip_counts = result.get()
+
+        # Chunk-local shard ids -> global ids (first come, first served)
+        local_to_global = np.empty(len(labels), dtype=np.int64)
+        for local, label in enumerate(labels):
+            if label not in self.labels:
+                if (len(self.labels) + 1) * self.triple_space >= 2 ** 63:
+                    raise ValueError(f"Too many shards ({len(self.labels) + 1}) for int64 keys")
+                self.labels[label] = len(self.labels)
+                self.trips.append(0)
+            local_to_global[local] = self.labels[label]
+            self.trips[self.labels[label]] += trip_counts[local]
+
+        if len(keys):
+            keys = local_to_global[keys // self.triple_space] * self.triple_space + keys % self.triple_space
+            order = np.argsort(keys, kind='stable')
+            self.partial_counts.add(keys[order], counts[order], first[order])
+        return sum(trip_counts)
+
+def save_csr(filename, matrix):
+    sparse.save_npz(filename, matrix, compressed=False)
+
+def build_sharded_matrices(json_file, total_sub_edges, edge_index, partition=('routeId',), out_dir=shards_dir,
+                           hour_bucket=1, time_field='timeStamp', utc_offset=7, windows=10, chunk_size=50,
+                           processes=None, memory_budget=512 * 1024 * 1024, spill_dir=None, max_triples=None,
+                           dedupe='global'):
+    for field in partition:
+        if field not in PARTITION_FIELDS:
+            raise ValueError(f"Unknown partition field {field!r}, expected one of {PARTITION_FIELDS}")
+
+    time1 = time.time()
+    edge_size = len(edge_index)
+    size = edge_size + 1
+    if isinstance(total_sub_edges, str):
+        SubEdgeLookup(total_sub_edges).check_edge_index(edge_index)
+        sub_edge_index = total_sub_edges
+    else:
+        sub_edge_index = get_sub_edge_index(total_sub_edges, edge_index)
+    partition_config = {'partition': tuple(partition), 'hour_bucket': hour_bucket,
+                        'time_field': time_field, 'utc_offset': utc_offset}
+    collector = ShardCollector(edge_size, memory_budget, spill_dir)
+    global_counts = PartialCounts(memory_budget, spill_dir)
+
+    try:
+        trip_count = 0
+        processes = processes or cpu_count()
+        with metrics.stage('count_shard_triples'), tqdm(unit='trip', desc='count_shard_triples') as progress, \
+                Pool(processes, initializer=init_shard_worker,
+                     initargs=(sub_edge_index, edge_size, windows, max_triples, dedupe, partition_config)) as pool:
+            pending = deque()
+            for task in enumerate(iter_line_chunks(json_file, chunk_size)):
+                pending.append(pool.apply_async(process_shard_chunk, task))
+                if len(pending) >= 2 * processes:
+                    progress.update(collector.add(pending.popleft()))
+            while pending:
+                progress.update(collector.add(pending.popleft()))
+            trip_count = progress.n
+        metrics.count('trips', trip_count)
+        print(f"Processed {trip_count} trips into {len(collector.labels)} shards")
+
+        # Shards occupy contiguous key ranges, so one merge serves all of them
+        shard_entries = [([], [], []) for _ in collector.labels]
+        with metrics.stage('merge_shard_runs'):
+            for keys, counts, first in merge_count_runs(collector.partial_counts.load_runs(), edge_size):
+                global_counts.add(*reduce_counts(keys % size ** 3, counts, first))
+                shard_rows, cols, inters = select_most_frequent(keys, counts, first, edge_size)
+                shards = shard_rows // size
+                for shard in np.unique(shards):
+                    selected = shards == shard
+                    shard_entries[shard][0].append(shard_rows[selected] % size)
+                    shard_entries[shard][1].append(cols[selected])
+                    shard_entries[shard][2].append(inters[selected].astype(np.int32))
+
+        os.makedirs(out_dir, exist_ok=True)
+        global_matrix = create_inter_edges_matrix_from_runs(global_counts.load_runs(), edge_size)
+        save_csr(os.path.join(out_dir, 'global.npz'), global_matrix)
+
+        shards = []
+        for label, shard in collector.labels.items():
+            rows, cols, inters = (np.concatenate(column) if column else np.empty(0, dtype=np.int64)
+                                  for column in shard_entries[shard])
+            matrix = sparse.csr_matrix((inters.astype(np.int32), (rows, cols)), shape=(size, size))
+            save_csr(os.path.join(out_dir, f"shard_{shard}.npz"), matrix)
+            shards.append({'label': label, 'file': f"shard_{shard}.npz", 'trips': collector.trips[shard],
+                           'nnz': int(matrix.nnz)})
+    finally:
+        collector.partial_counts.cleanup()
+        global_counts.cleanup()
+
+    manifest = {
+        'version': SHARDS_VERSION,
+        'edge_size': edge_size,
+        'windows': windows,
+        'max_triples': max_triples,
+        'dedupe': dedupe,
+        'partition': list(partition),
+        'hour_bucket': hour_bucket,
+        'time_field': time_field,
+        'utc_offset': utc_offset,
+        'global': {'file': 'global.npz', 'trips': trip_count, 'nnz': int(global_matrix.nnz)},
+        'shards': shards,
+    }
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    time2 = time.time()
+    print(f"Save {len(shards)} shards to {out_dir} successfully ({time2-time1}s)")
+    return manifest
+
+# Per-route and per-(route, 3-hour slice) matrices in one pass
+# edge_index = load_edge_index(index_file)
+# build_sharded_matrices(json_file, sub_edges_dir, edge_index, partition=('routeId',))
+# build_sharded_matrices(json_file, sub_edges_dir, edge_index, partition=('routeId', 'hour'), hour_bucket=3,
+#                        out_dir='output/inter_edges_shards_route_hour')
@@ -0,0 +1,93 @@
+import json
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from edge_matrix import *
+from benchmark_suite import generate_synthetic_data
+
+
+"""
+[module: test_edge_matrix]
+
+Parity of the vectorized, streaming and parallel builds with the
+original dict-based path (process_intermediate_edges ->
+merge_edges_frequency -> create_inter_edges_matrix) on a small
+synthetic history, ties included.
+
+python -m pytest tests
+"""
+
+@pytest.fixture(scope='module')
+def synthetic_data(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('synthetic'))
+    generate_synthetic_data(data_dir, n_ways=300, n_vehicles=6, trips_per_vehicle=3, seed=1)
+    with open(os.path.join(data_dir, 'total_edges'), 'r') as f:
+        edge_index = get_edge_index(json.load(f))
+    total_sub_edges = load_total_sub_edges(os.path.join(data_dir, 'total_sub_edges'))
+    return os.path.join(data_dir, 'bus_history.json'), total_sub_edges, edge_index
+
+def build_expected(json_file, total_sub_edges, edge_index, windows, dedupe):
+    # Serial dict-based reference
+    with open(json_file, 'r') as f:
+        trips = [trip for line in f if line.strip() for trip in json.loads(line)['tripList']]
+    edge_freqs_list = [process_intermediate_edges(trip, total_sub_edges, windows, dedupe) for trip in trips]
+    return create_inter_edges_matrix(merge_edges_frequency(edge_freqs_list), len(edge_index), edge_index)
+
+def assert_same_matrix(result, expected):
+    assert result.shape == expected.shape
+    assert (result != expected).nnz == 0
+
+@pytest.mark.parametrize('dedupe', ['global', 'consecutive'])
+@pytest.mark.parametrize('windows', [10, None])
+def test_builds_match_dict_path(synthetic_data, tmp_path, windows, dedupe):
+    json_file, total_sub_edges, edge_index = synthetic_data
+    expected = build_expected(json_file, total_sub_edges, edge_index, windows, dedupe)
+    assert expected.nnz > 0
+
+    assert_same_matrix(build_inter_edges_matrix(json_file, total_sub_edges, edge_index, windows, dedupe=dedupe),
+                       expected)
+    # A tiny memory budget forces spilled runs through the k-way merge
+    assert_same_matrix(build_inter_edges_matrix_streaming(json_file, total_sub_edges, edge_index, windows,
+                                                          chunk_size=4, memory_budget=1 << 16,
+                                                          spill_dir=str(tmp_path), dedupe=dedupe), expected)
+    assert_same_matrix(build_inter_edges_matrix_parallel(json_file, total_sub_edges, edge_index, windows,
+                                                         chunk_size=2, processes=2, memory_budget=1 << 16,
+                                                         spill_dir=str(tmp_path), dedupe=dedupe), expected)
+
+def test_consecutive_keeps_loops(synthetic_data):
+    # The synthetic walks revisit ways, so the two dedupe modes must actually differ
+    json_file, total_sub_edges, edge_index = synthetic_data
+    differences = (build_expected(json_file, total_sub_edges, edge_index, 10, 'global')
+                   != build_expected(json_file, total_sub_edges, edge_index, 10, 'consecutive')).nnz
+    assert differences > 0
+
+def test_shards_match_partition_builds(synthetic_data, tmp_path):
+    # Collector and global counts both spill into the same explicit spill_dir
+    from shard_matrix import build_sharded_matrices, get_partition_label
+    json_file, total_sub_edges, edge_index = synthetic_data
+    partition = ('routeId', 'hour')
+    out_dir = str(tmp_path / 'shards')
+    build_sharded_matrices(json_file, total_sub_edges, edge_index, partition, out_dir, hour_bucket=6,
+                           chunk_size=2, processes=2, memory_budget=1 << 14, spill_dir=str(tmp_path / 'spill'))
+
+    trips = defaultdict(list)
+    all_trips = []
+    with open(json_file, 'r') as f:
+        for line in f:
+            vehicle = json.loads(line)
+            for trip in vehicle['tripList']:
+                trips[get_partition_label(vehicle, trip, partition, 6)].append(trip)
+                all_trips.append(trip)
+    with open(os.path.join(out_dir, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+    assert sorted(shard['label'] for shard in manifest['shards']) == sorted(trips)
+
+    def build_partition(partition_trips):
+        edge_freqs_list = [process_intermediate_edges(trip, total_sub_edges) for trip in partition_trips]
+        return create_inter_edges_matrix(merge_edges_frequency(edge_freqs_list), len(edge_index), edge_index)
+
+    for shard in manifest['shards']:
+        assert_same_matrix(sparse.load_npz(os.path.join(out_dir, shard['file'])), build_partition(trips[shard['label']]))
+    assert_same_matrix(sparse.load_npz(os.path.join(out_dir, 'global.npz')), build_partition(all_trips))
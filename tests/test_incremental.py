@@ -0,0 +1,73 @@
+import json
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from incremental import *
+from benchmark_suite import generate_synthetic_data
+
+
+"""
+[module: test_incremental]
+
+Folding a history into the count store batch by batch gives the matrix
+and top-K of one full build; decayed top-K counts stay on the store's
+scale.
+
+python -m pytest tests
+"""
+
+@pytest.fixture(scope='module')
+def batches(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('synthetic'))
+    generate_synthetic_data(data_dir, n_ways=300, n_vehicles=8, trips_per_vehicle=3, seed=2)
+    with open(os.path.join(data_dir, 'total_edges'), 'r') as f:
+        edge_index = get_edge_index(json.load(f))
+    total_sub_edges = load_total_sub_edges(os.path.join(data_dir, 'total_sub_edges'))
+
+    json_file = os.path.join(data_dir, 'bus_history.json')
+    with open(json_file, 'r') as f:
+        lines = [line for line in f if line.strip()]
+    files = []
+    for name, part in (('day1.json', lines[:5]), ('day2.json', lines[5:])):
+        files.append(os.path.join(data_dir, name))
+        with open(files[-1], 'w') as f:
+            f.writelines(part)
+    return json_file, files, total_sub_edges, edge_index
+
+def test_ingest_matches_full_build(batches, tmp_path):
+    json_file, (day1, day2), total_sub_edges, edge_index = batches
+    store_dir, matrix, top_k_file = str(tmp_path / 'store'), str(tmp_path / 'm.npz'), str(tmp_path / 'top_k.npz')
+    seed_count_store(day1, total_sub_edges, edge_index, store_dir, matrix, top_k_file, processes=2)
+    ingest_batch(day2, total_sub_edges, edge_index, store_dir, matrix, top_k_file, processes=2)
+
+    expected = build_inter_edges_matrix(json_file, total_sub_edges, edge_index)
+    assert (load_inter_edges_matrix(matrix) != expected).nnz == 0
+    expected_top_k = build_top_k_inter_edges(json_file, total_sub_edges, edge_index, processes=2)
+    top_k = load_top_k(top_k_file)
+    for name in ('pair_keys', 'offsets', 'inters', 'counts', 'totals'):
+        assert np.array_equal(top_k[name], expected_top_k[name]), name
+
+def test_decayed_top_k_follows_store(batches, tmp_path):
+    _, (day1, day2), total_sub_edges, edge_index = batches
+    store_dir, matrix, top_k_file = str(tmp_path / 'store'), str(tmp_path / 'm.npz'), str(tmp_path / 'top_k.npz')
+    ingest_batch(day1, total_sub_edges, edge_index, store_dir, matrix, top_k_file, processes=2)
+    ingest_batch(day2, total_sub_edges, edge_index, store_dir, matrix, top_k_file, decay=0.5, processes=2)
+
+    store = CountStore(store_dir)
+    pair_keys, starts = np.unique(store.keys // (len(edge_index) + 1), return_index=True)
+    top_k = load_top_k(top_k_file)
+    assert np.array_equal(top_k['pair_keys'], pair_keys)
+    assert np.array_equal(top_k['totals'], np.rint(np.add.reduceat(store.counts, starts)).astype(np.uint32))
+
+def test_new_store_keeps_existing_matrix(batches, tmp_path):
+    _, (day1, _), total_sub_edges, edge_index = batches
+    matrix = str(tmp_path / 'm.npz')
+    with open(matrix, 'wb') as f:
+        f.write(b'full build')
+    with pytest.raises(FileExistsError):
+        ingest_batch(day1, total_sub_edges, edge_index, str(tmp_path / 'store'), matrix, processes=2)
+    with open(matrix, 'rb') as f:
+        assert f.read() == b'full build'
@@ -1,4 +1,7 @@
 import json
+import os
+import numpy as np
+from array import array
 from tqdm import tqdm
 
 
@@ -45,17 +48,191 @@ class Vehicle:
         self._tripList = tripList
 
 
+# Columnar trip store: one row per vehicle (vehicleNumber / routeId / varId)
+# and per trip (owning vehicle, offset into one flat int64 array of sub-edge
+# node pairs). The trip's other fields (timeStamp, ...) are kept as UTF-8 JSON
+# in one flat byte array. Built once from the JSON lines file, then memory-mapped.
+TRIP_STORE_VERSION = 3
+INDEX_KEYS = {'routeId': 'route_ids', 'varId': 'var_ids', 'vehicleNumber': 'vehicle_numbers'}
+
+def get_trip_store_dir(fileName):
+    return f"jsonFiles/{os.path.splitext(fileName)[0]}.store"
+
+def convert_to_trip_store(fileName, store_dir=None):
+    store_dir = store_dir or get_trip_store_dir(fileName)
+    os.makedirs(store_dir, exist_ok=True)
+    
+    vehicle_numbers, route_ids, var_ids = [], [], []
+    trip_vehicles, trip_lengths, sub_edges = array('q'), array('q'), array('q')
+    trip_fields, trip_field_lengths = bytearray(), array('q')
+    with open(f"jsonFiles/{fileName}", "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            for trip in data['tripList']:
+                edges = trip['edgesOfPath2']
+                trip_vehicles.append(len(vehicle_numbers))
+                trip_lengths.append(len(edges))
+                sub_edges.extend(int(node) for edge in edges for node in edge)
+                # Key order is kept: edgesOfPath2 stays in place as null
+                fields = json.dumps({key: None if key == 'edgesOfPath2' else value
+                                     for key, value in trip.items()}).encode()
+                trip_fields.extend(fields)
+                trip_field_lengths.append(len(fields))
+            vehicle_numbers.append(data['vehicleNumber'])
+            route_ids.append(data['routeId'])
+            var_ids.append(data['varId'])
+    
+    trip_offsets = np.zeros(len(trip_lengths) + 1, dtype=np.int64)
+    np.cumsum(np.frombuffer(trip_lengths, dtype=np.int64), out=trip_offsets[1:])
+    trip_field_offsets = np.zeros(len(trip_field_lengths) + 1, dtype=np.int64)
+    np.cumsum(np.frombuffer(trip_field_lengths, dtype=np.int64), out=trip_field_offsets[1:])
+    columns = {
+        'vehicle_numbers': np.array(vehicle_numbers, dtype=str),
+        'route_ids': np.array(route_ids),
+        'var_ids': np.array(var_ids),
+        'trip_vehicles': np.frombuffer(trip_vehicles, dtype=np.int64).astype(np.int32),
+        'trip_offsets': trip_offsets,
+        'sub_edges': np.frombuffer(sub_edges, dtype=np.int64).reshape(-1, 2),
+        'trip_fields': np.frombuffer(bytes(trip_fields), dtype=np.uint8),
+        'trip_field_offsets': trip_field_offsets,
+    }
+    
+    # Trips are stored vehicle by vehicle, so each vehicle owns one trip range
+    columns['vehicle_trip_offsets'] = np.searchsorted(columns['trip_vehicles'],
+                                                      np.arange(len(vehicle_numbers) + 1)).astype(np.int64)
+    for key, column in INDEX_KEYS.items():
+        columns.update(build_secondary_index(key, columns[column]))
+    
+    for name, column in columns.items():
+        np.save(os.path.join(store_dir, f"{name}.npy"), column)
+    
+    source = os.stat(f"jsonFiles/{fileName}")
+    manifest = {'version': TRIP_STORE_VERSION, 'source': fileName, 'source_size': source.st_size,
+                'source_mtime': source.st_mtime, 'vehicles': len(vehicle_numbers), 'trips': len(trip_lengths)}
+    with open(os.path.join(store_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    
+    print(f"Convert {fileName} to trip store successfully")
+    return store_dir
+
+def build_secondary_index(key, column):
+    # key value -> vehicles (CSR: values[i] owns vehicles[offsets[i]:offsets[i + 1]])
+    vehicles = np.argsort(column, kind='stable')
+    values, counts = np.unique(column[vehicles], return_counts=True)
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return {
+        f"index_{key}_values": values,
+        f"index_{key}_offsets": offsets,
+        f"index_{key}_vehicles": vehicles.astype(np.int32),
+    }
+
+def is_trip_store_current(fileName, store_dir):
+    try:
+        with open(os.path.join(store_dir, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return False
+    source = os.stat(f"jsonFiles/{fileName}")
+    return (manifest.get('version') == TRIP_STORE_VERSION and manifest['source_size'] == source.st_size
+            and manifest['source_mtime'] == source.st_mtime)
+
 class VehicleQuery:
-    def __init__(self, fileName):
-        self.vehicleList = []
-        self.loadJson(fileName)
+    """
+    Lazy view over the trip store of a bus_history file. Filtering only
+    narrows the selected vehicles (and so their trip ids); Vehicle objects
+    are built on demand. A view can be passed to
+    edge_matrix.build_inter_edges_matrix_from_query.
+    """
+    def __init__(self, fileName, store_dir=None, vehicles=None):
+        self.fileName = fileName
+        self.store_dir = store_dir or get_trip_store_dir(fileName)
+        if vehicles is None and not is_trip_store_current(fileName, self.store_dir):
+            convert_to_trip_store(fileName, self.store_dir)
+        self.loadStore()
+        self.vehicles = np.arange(len(self.vehicle_numbers)) if vehicles is None else vehicles
         
-    def loadJson(self, fileName):
-        with open(f"jsonFiles/{fileName}", "r") as file:
-            for line in file:
-                data = json.loads(line)              
-                vehicle = Vehicle(**data)
-                self.vehicleList.append(vehicle)
+        # Every trip of the selected vehicles, in store order
+        starts = self.vehicle_trip_offsets[self.vehicles]
+        lengths = self.vehicle_trip_offsets[self.vehicles + 1] - starts
+        self.trips = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
 
-    
-        
\ No newline at end of file
+    def loadStore(self):
+        for name in ('vehicle_numbers', 'route_ids', 'var_ids', 'trip_vehicles', 'trip_offsets', 'sub_edges',
+                     'vehicle_trip_offsets', 'trip_fields', 'trip_field_offsets'):
+            setattr(self, name, np.load(os.path.join(self.store_dir, f"{name}.npy"), mmap_mode='r'))
+        self.indexes = {key: tuple(np.load(os.path.join(self.store_dir, f"index_{key}_{part}.npy"), mmap_mode='r')
+                                   for part in ('values', 'offsets', 'vehicles'))
+                        for key in INDEX_KEYS}
+
+    def __len__(self):
+        return len(self.trips)
+
+    def getVehicleIds(self, key, value):
+        # Sorted vehicles with `key` == value (whole store)
+        values, offsets, vehicles = self.indexes[key]
+        i = np.searchsorted(values, value)
+        if i == len(values) or values[i] != value:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(vehicles[offsets[i]:offsets[i + 1]]).astype(np.int64)
+
+    def getTripRanges(self, key, value):
+        # [starts, ends) trip ranges of every vehicle with `key` == value (whole store)
+        matched = self.getVehicleIds(key, value)
+        return self.vehicle_trip_offsets[matched], self.vehicle_trip_offsets[matched + 1]
+
+    def getTripIds(self, key, value):
+        starts, ends = self.getTripRanges(key, value)
+        lengths = ends - starts
+        return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    def filter(self, routeId=None, varId=None, vehicleNumber=None):
+        # Every key is a vehicle field, so vehicles without trips stay selectable
+        vehicles = self.vehicles
+        for key, value in (('routeId', routeId), ('varId', varId), ('vehicleNumber', vehicleNumber)):
+            if value is not None:
+                vehicles = np.intersect1d(vehicles, self.getVehicleIds(key, value), assume_unique=True)
+        return VehicleQuery(self.fileName, self.store_dir, vehicles)
+
+    def tripsByRoute(self, routeId):
+        return self.filter(routeId=routeId)
+
+    def tripsByVar(self, varId):
+        return self.filter(varId=varId)
+
+    def tripsByVehicle(self, vehicleNumber):
+        return self.filter(vehicleNumber=vehicleNumber)
+
+    def getEdgeArray(self):
+        # All selected trips' sub-edges as one (n, 2) array, with per-trip offsets
+        starts = self.trip_offsets[self.trips]
+        lengths = self.trip_offsets[self.trips + 1] - starts
+        slots = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return self.sub_edges[slots], offsets
+
+    def getTripEdges(self, trip):
+        # (n, 2) node ids of one trip (a view on the memory-mapped store)
+        return self.sub_edges[self.trip_offsets[trip]:self.trip_offsets[trip + 1]]
+
+    def iterTripEdges(self):
+        for trip in self.trips:
+            yield self.getTripEdges(trip)
+
+    def getTrip(self, trip):
+        # One trip dict as in the JSON (every field, sub-edge node ids as str)
+        fields = bytes(self.trip_fields[self.trip_field_offsets[trip]:self.trip_field_offsets[trip + 1]])
+        trip_dict = json.loads(fields)
+        trip_dict['edgesOfPath2'] = [[str(u), str(w)] for u, w in self.getTripEdges(trip).tolist()]
+        return trip_dict
+
+    @property
+    def vehicleList(self):
+        # Materializes Vehicle objects (tripList as in the JSON) for the selected vehicles
+        return [Vehicle(str(self.vehicle_numbers[v]), self.route_ids[v].item(), self.var_ids[v].item(),
+                        [self.getTrip(trip) for trip in range(self.vehicle_trip_offsets[v],
+                                                              self.vehicle_trip_offsets[v + 1])])
+                for v in self.vehicles.tolist()]
@@ -1,31 +1,256 @@
-import osmnx as ox
-import folium
-from folium.plugins import MarkerCluster
+import json
+import os
 import random
+import sys
+import numpy as np
+from edge_matrix import *
 
 
-"""  
+"""
 [module: visualization]
 
 This module is used to visualize HCM.osm map for better
 handling data and get a good structure
+
+render_layers reads the lean way / node arrays (graph.load_osm_arrays)
+instead of osmnx and writes one pre-aggregated GeoJSON layer per zoom
+level (optionally cut into z/x/y tiles). Geometry is snapped to the
+zoom's pixel grid, so it is simplified and clustered per zoom, and
+every layer is capped in features and coordinates. Ways can be all
+highways, only the ways of the inter_edges_matrix, or weighted by the
+number of trips that use them.
+
+python visualize.py [all|matrix|frequency]   (lean layers)
+python visualize.py sample                    (original osmnx + folium map)
 """
 
-G = ox.graph_from_xml('osmFiles/HoChiMinh.osm')
+layers_dir = 'output/map_layers'
+TILE_SIZE = 256
+
+def render_sampled_map(osm_file=osm_file, output_file='hcmc_map.html', frac=0.1):
+    # Original rendering: whole graph through osmnx, 10% random nodes / edges drawn one by one
+    import osmnx as ox
+    import folium
+    from folium.plugins import MarkerCluster
+
+    G = ox.graph_from_xml(osm_file)
+
+    nodes, edges = ox.graph_to_gdfs(G)
+
+    sampled_nodes = nodes.sample(frac=frac)
+    sampled_edges = edges.sample(frac=frac)
+
+    m = folium.Map(location=[10.8231, 106.6297], zoom_start=11)
+
+    mc = MarkerCluster()
+    for idx, node in sampled_nodes.iterrows():
+        folium.CircleMarker([node['y'], node['x']], radius=2).add_to(mc)
+    mc.add_to(m)
+
+    for idx, edge in sampled_edges.iterrows():
+        folium.PolyLine(edge['geometry'].coords, weight=2, color='red').add_to(m)
+
+    m.save(output_file)
+
+def get_pixel_degrees(zoom):
+    # Width of one screen pixel in degrees of longitude at this zoom
+    return 360.0 / (TILE_SIZE * 2 ** zoom)
+
+def get_tile_xy(lat, lon, zoom):
+    # Slippy-map (XYZ) tile of every coordinate
+    n = 2 ** zoom
+    lat = np.radians(np.clip(lat, -85.0511, 85.0511))
+    x = np.floor((np.asarray(lon) + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+def get_way_positions(osm_arrays, way_ids):
+    # Position in osm_arrays.ways of every way id, -1 if the extract does not have it
+    way_ids = np.asarray(way_ids, dtype=np.int64)
+    order = np.argsort(osm_arrays.ways, kind='stable')
+    sorted_ways = osm_arrays.ways[order]
+    if len(sorted_ways) == 0:
+        return np.full(way_ids.shape, -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(sorted_ways, way_ids), len(sorted_ways) - 1)
+    return np.where(sorted_ways[pos] == way_ids, order[pos], -1)
+
+def get_matrix_way_weights(inter_edges_matrix, edge_index):
+    # Way ids referenced by the matrix (row, column or intermediate) and how many entries use each
+    coo = inter_edges_matrix.tocoo()
+    indices = np.concatenate([coo.row, coo.col, coo.data]).astype(np.int64)
+    indices, counts = np.unique(indices[indices > 0], return_counts=True)
+    return edge_index.to_way_ids(indices), counts
+
+def get_trip_way_weights(json_file, sub_edge_lookup):
+    # Number of trips that use each way (a way counts once per trip)
+    trips_per_way = np.zeros(len(sub_edge_lookup.ways), dtype=np.int64)
+    for trip in iter_trips(json_file):
+        edges, _ = map_trip(trip, sub_edge_lookup)
+        trips_per_way[np.unique(edges) - 1] += 1
+    used = trips_per_way > 0
+    return np.asarray(sub_edge_lookup.ways)[used], trips_per_way[used]
+
+def get_way_coordinates(osm_arrays, positions):
+    # Flat lat / lon of the selected ways, with offsets (way i owns [offsets[i], offsets[i + 1]))
+    starts = osm_arrays.way_offsets[positions]
+    lengths = osm_arrays.way_offsets[positions + 1] - starts
+    offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    slots = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    node_pos = np.searchsorted(osm_arrays.nodes, osm_arrays.way_nodes[slots])
+    return osm_arrays.lat[node_pos], osm_arrays.lon[node_pos], offsets
+
+def simplify_ways(lat, lon, offsets, zoom):
+    """
+    Snap every vertex to the zoom's pixel grid and drop vertices that land
+    on the same cell as the previous one. Ways that shrink to a single cell
+    are invisible at this zoom and are dropped (kept = False).
+    """
+    cell = get_pixel_degrees(zoom)
+    lat = np.round(lat / cell) * cell
+    lon = np.round(lon / cell) * cell
+    way = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    keep = np.ones(len(lat), dtype=bool)
+    keep[1:] = (lat[1:] != lat[:-1]) | (lon[1:] != lon[:-1]) | (way[1:] != way[:-1])
+    keep &= ~np.isnan(lat) & ~np.isnan(lon)
+    lengths = np.bincount(way[keep], minlength=len(offsets) - 1)
+
+    new_offsets = np.zeros(len(offsets), dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    return lat[keep], lon[keep], new_offsets, lengths >= 2
+
+def cluster_nodes(lat, lon, zoom, cell_pixels=32):
+    # One point per grid cell of `cell_pixels` pixels: cell centroid and number of nodes
+    cell = get_pixel_degrees(zoom) * cell_pixels
+    valid = ~np.isnan(lat) & ~np.isnan(lon)
+    lat, lon = lat[valid], lon[valid]
+    cells = np.stack([np.floor(lat / cell), np.floor(lon / cell)], axis=1).astype(np.int64)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    return (np.bincount(inverse, weights=lat) / counts, np.bincount(inverse, weights=lon) / counts, counts)
+
+def select_within_budget(weights, lengths, max_features, max_coordinates):
+    # Heaviest ways first until either budget is used up
+    order = np.argsort(-weights, kind='stable')[:max_features]
+    within = np.cumsum(lengths[order]) <= max_coordinates
+    return np.sort(order[within])
+
+def get_zoom_layer(osm_arrays, positions, weights, zoom, max_features=20000, max_coordinates=500000,
+                   cluster_pixels=32):
+    """
+    GeoJSON FeatureCollection of the given ways at one zoom level: simplified
+    LineStrings (with way id and weight) plus clustered node points, within
+    the feature / coordinate budget.
+    """
+    lat, lon, offsets = get_way_coordinates(osm_arrays, positions)
+    lat, lon, offsets, visible = simplify_ways(lat, lon, offsets, zoom)
+
+    visible_ways = np.flatnonzero(visible)
+    selected = visible_ways[select_within_budget(weights[visible_ways], np.diff(offsets)[visible_ways],
+                                                 max_features, max_coordinates)]
+    round_digits = max(0, int(np.ceil(-np.log10(get_pixel_degrees(zoom)))))
+
+    features = []
+    for i in selected.tolist():
+        coordinates = np.stack([lon[offsets[i]:offsets[i + 1]], lat[offsets[i]:offsets[i + 1]]], axis=1)
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'LineString', 'coordinates': np.round(coordinates, round_digits).tolist()},
+            'properties': {'wayId': int(osm_arrays.ways[positions[i]]), 'weight': float(weights[i])},
+        })
+
+    if cluster_pixels:
+        # Cluster the unsimplified vertices of the drawn ways
+        node_lat, node_lon, _ = get_way_coordinates(osm_arrays, positions[selected])
+        cluster_lat, cluster_lon, counts = cluster_nodes(node_lat, node_lon, zoom, cluster_pixels)
+        # Points share the budget with the lines: keep the largest clusters that still fit
+        used_coordinates = int(np.diff(offsets)[selected].sum())
+        room = max(0, min(max_features - len(selected), max_coordinates - used_coordinates))
+        for cluster in np.argsort(-counts, kind='stable')[:room].tolist():
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [round(float(cluster_lon[cluster]), round_digits),
+                                                              round(float(cluster_lat[cluster]), round_digits)]},
+                'properties': {'nodes': int(counts[cluster])},
+            })
+
+    return {'type': 'FeatureCollection', 'zoom': zoom, 'features': features}
+
+def split_into_tiles(layer, zoom, max_features_per_tile=2000):
+    # Feature lists per (x, y) tile; a line goes to every tile its bounding box touches
+    tiles = defaultdict(list)
+    for feature in layer['features']:
+        coordinates = np.asarray(feature['geometry']['coordinates'], dtype=np.float64).reshape(-1, 2)
+        x, y = get_tile_xy(coordinates[:, 1], coordinates[:, 0], zoom)
+        for tile_x in range(int(x.min()), int(x.max()) + 1):
+            for tile_y in range(int(y.min()), int(y.max()) + 1):
+                if len(tiles[(tile_x, tile_y)]) < max_features_per_tile:
+                    tiles[(tile_x, tile_y)].append(feature)
+    return tiles
 
-nodes, edges = ox.graph_to_gdfs(G)
+def write_geojson(filename, feature_collection):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(feature_collection, f, separators=(',', ':'))
 
-sampled_nodes = nodes.sample(frac=0.1)
-sampled_edges = edges.sample(frac=0.1)
+def render_layers(osm_arrays, out_dir=layers_dir, zooms=(11, 13, 15), ways='all', inter_edges_matrix=None,
+                  edge_index=None, json_file=None, sub_edge_lookup=None, max_features=20000,
+                  max_coordinates=500000, tiles=False, max_features_per_tile=2000):
+    """
+    Write one GeoJSON layer per zoom (layer_z{zoom}.geojson), or z/x/y tiles
+    with tiles=True.
+    ways='all'       every highway way, longer ways first when over budget
+    ways='matrix'    ways used by inter_edges_matrix (needs edge_index)
+    ways='frequency' ways weighted by the trips of json_file (needs sub_edge_lookup)
+    """
+    if ways == 'all':
+        positions = np.arange(len(osm_arrays.ways), dtype=np.int64)
+        weights = np.diff(osm_arrays.way_offsets).astype(np.float64)
+    else:
+        if ways == 'matrix':
+            way_ids, weights = get_matrix_way_weights(inter_edges_matrix, edge_index)
+        elif ways == 'frequency':
+            way_ids, weights = get_trip_way_weights(json_file, sub_edge_lookup)
+        else:
+            raise ValueError(f"Unknown ways mode {ways!r}, expected 'all', 'matrix' or 'frequency'")
+        positions = get_way_positions(osm_arrays, way_ids)
+        found = positions >= 0
+        positions, weights = positions[found], weights[found].astype(np.float64)
 
-m = folium.Map(location=[10.8231, 106.6297], zoom_start=11)
+    written = {}
+    for zoom in zooms:
+        layer = get_zoom_layer(osm_arrays, positions, weights, zoom, max_features, max_coordinates)
+        if tiles:
+            for (tile_x, tile_y), features in split_into_tiles(layer, zoom, max_features_per_tile).items():
+                write_geojson(os.path.join(out_dir, str(zoom), str(tile_x), f"{tile_y}.geojson"),
+                              {'type': 'FeatureCollection', 'features': features})
+            written[zoom] = os.path.join(out_dir, str(zoom))
+        else:
+            written[zoom] = os.path.join(out_dir, f"layer_z{zoom}.geojson")
+            write_geojson(written[zoom], layer)
+        print(f"Save zoom {zoom} layer ({len(layer['features'])} features) to {written[zoom]} successfully")
+    return written
 
-mc = MarkerCluster()
-for idx, node in sampled_nodes.iterrows():
-    folium.CircleMarker([node['y'], node['x']], radius=2).add_to(mc)
-mc.add_to(m)
+def render_layer_map(layer_file, output_file='hcmc_map.html', location=(10.8231, 106.6297), zoom_start=11):
+    # One folium GeoJson layer for the whole file instead of one PolyLine per edge
+    import folium
 
-for idx, edge in sampled_edges.iterrows():
-    folium.PolyLine(edge['geometry'].coords, weight=2, color='red').add_to(m)
+    m = folium.Map(location=list(location), zoom_start=zoom_start)
+    folium.GeoJson(layer_file, name=os.path.basename(layer_file)).add_to(m)
+    m.save(output_file)
 
-m.save('hcmc_map.html')
\ No newline at end of file
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'all'
+    if mode == 'sample':
+        render_sampled_map()
+    else:
+        osm_arrays = load_osm_arrays(osm_file)
+        if mode == 'matrix':
+            render_layers(osm_arrays, ways='matrix', inter_edges_matrix=load_inter_edges_matrix(matrix_file),
+                          edge_index=open_edge_index(index_file))
+        elif mode == 'frequency':
+            render_layers(osm_arrays, ways='frequency', json_file=json_file,
+                          sub_edge_lookup=load_sub_edges_bundle(sub_edges_dir))
+        else:
+            render_layers(osm_arrays)